@@ -24,8 +24,13 @@ setup(
         "License :: Harvard University :: Development",
         "Operating System :: OS Independent"],
     install_requires=[
-        'nsaph>=0.0.2.7'
+        'nsaph>=0.0.2.7',
+        'numpy'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4']
+    },
     package_data = {
         '': ["**/*.yaml"]
     }
@@ -17,7 +17,9 @@
 #  limitations under the License.
 #
 
-from typing import Dict
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 import logging
 
@@ -25,63 +27,182 @@ from nsaph import init_logging
 from nsaph.db import Connection
 from nsaph.loader.common import DBConnectionConfig
 
+from cms.tools.options import split_arguments
+from cms.verification import Verifier, DEFAULT_PROFILES
+
+
+DEFAULT_TABLES = [
+    'cms.ps',
+    'medicaid.beneficiaries',
+    'medicaid.enrollments',
+    'medicaid.eligibility'
+]
+
+# Default allowed relative difference between an estimated and
+# the expected number of rows
+ESTIMATE_TOLERANCE = 0.05
+
 
 class Aggregator:
-    QUERY = """
-    SELECT
-        1 as ORD,
-        'cms.ps' as table, 
-        COUNT(*) 
-    FROM 
-        "cms"."ps"
-    UNION
-    SELECT
-        2 as ORD,
-        'medicaid.beneficiaries' as table, 
-        COUNT(*) 
-    FROM 
-        "medicaid"."beneficiaries"
-    UNION
-    SELECT
-        3 as ORD,
-        'medicaid.enrollments' as table, 
-        COUNT(*) 
-    FROM 
-        "medicaid"."enrollments"
-    UNION
+    COUNT = 'SELECT COUNT(*) FROM {}'
+
+    # Estimated number of rows in a table, including its partitions
+    # or inherited tables. Tables, that have never been analyzed,
+    # have negative reltuples, for them the number of live tuples
+    # from the statistics collector is used
+    ESTIMATE = """
+    WITH RECURSIVE tree AS (
+        SELECT
+            c.oid
+        FROM
+            pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+        UNION ALL
+        SELECT
+            i.inhrelid
+        FROM
+            pg_inherits i
+            JOIN tree t ON i.inhparent = t.oid
+    )
     SELECT
-        4 as ORD,
-        'medicaid.eligibility' as table, 
-        COUNT(*) 
-    FROM 
-        "medicaid"."eligibility"
-    ORDER BY 1
+        COUNT(*),
+        SUM(
+            CASE
+                WHEN c.reltuples >= 0 THEN c.reltuples
+                ELSE COALESCE(s.n_live_tup, 0)
+            END
+        )::bigint
+    FROM
+        tree t
+        JOIN pg_class c ON c.oid = t.oid
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.relkind <> 'p'
     """
 
-    def __init__(self, context: DBConnectionConfig = None):
+    def __init__(self, context: DBConnectionConfig = None,
+                 tables: List[str] = None):
+        """
+        :param context: Database connection configuration
+        :param tables: Qualified names of the tables to count,
+            by default: cms.ps and medicaid tables
+        """
+
         init_logging()
         if not context:
             context = DBConnectionConfig(None, __doc__).instantiate()
         self.context = context
+        self.tables = tables if tables else list(DEFAULT_TABLES)
+
+    def connect(self):
+        return Connection(self.context.db,
+                          self.context.connection,
+                          silent=True).connect()
+
+    @staticmethod
+    def split_name(table: str):
+        if '.' in table:
+            schema, name = table.split('.', 1)
+        else:
+            schema, name = "public", table
+        return schema, name
+
+    @classmethod
+    def quote(cls, table: str) -> str:
+        return '.'.join(
+            '"{}"'.format(part.replace('"', '""'))
+            for part in cls.split_name(table)
+        )
+
+    def count_table(self, table: str) -> int:
+        """
+        Counts rows in a table on a separate connection
+        """
+
+        with self.connect() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(self.COUNT.format(self.quote(table)))
+                n = cursor.fetchone()[0]
+        logging.info("{}: {:,d}".format(table, n))
+        return n
+
+    def count(self, tables: List[str] = None) -> Dict[str,int]:
+        """
+        Counts rows exactly. Every table is counted in a separate
+        thread, using its own database connection
 
-    def count(self) -> Dict[str,int]:
+        :param tables: Tables to count, by default the tables
+            given to the constructor
+        :return: Dictionary mapping table names to numbers of rows
+        """
+
+        if tables is None:
+            tables = self.tables
+        if not tables:
+            return dict()
+        with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+            counts = executor.map(self.count_table, tables)
+            return dict(zip(tables, counts))
+
+    def estimate(self, tables: List[str] = None) -> Dict[str,int]:
+        """
+        Estimates numbers of rows from the planner statistics without
+        scanning the tables. The estimates are as accurate as
+        the last ANALYZE (or VACUUM) of the tables
+
+        :param tables: Tables to count, by default the tables
+            given to the constructor
+        :return: Dictionary mapping table names to estimated
+            numbers of rows
+        """
+
+        if tables is None:
+            tables = self.tables
         counts = dict()
-        with Connection(self.context.db,
-                        self.context.connection,
-                        silent=True).connect() as connection:
+        with self.connect() as connection:
             with connection.cursor() as cursor:
-                cursor.execute(self.QUERY)
-                for row in cursor:
-                    table = row[1]
-                    n = row[2]
-                    logging.info("{}: {:,d}".format(table, n))
+                for table in tables:
+                    cursor.execute(self.ESTIMATE, self.split_name(table))
+                    found, n = cursor.fetchone()
+                    if not found:
+                        raise ValueError("Table not found: " + table)
+                    n = n or 0
+                    logging.info("{}: ~{:,d}".format(table, n))
                     counts[table] = n
         return counts
 
-    def verify(self, expected):
-        actual = self.count()
+    @staticmethod
+    def deviation(expected: int, actual: int) -> float:
+        """
+        Relative difference between the actual and expected numbers
+        """
+
+        if expected == actual:
+            return 0.0
+        return abs(actual - expected) / max(abs(expected), 1)
+
+    def verify(self, expected: Dict[str, int], exact: bool = True,
+               tolerance: float = ESTIMATE_TOLERANCE):
+        """
+        Compares numbers of rows with the expected ones
+
+        :param expected: Dictionary mapping table names to
+            expected numbers of rows
+        :param exact: If False, planner estimates are compared,
+            which only makes sense right after ANALYZE
+        :param tolerance: Allowed relative difference between
+            estimated and expected numbers of rows, ignored
+            when the rows are counted exactly
+        """
+
+        tables = list(expected)
+        if exact:
+            actual = self.count(tables)
+            tolerance = 0.0
+        else:
+            actual = self.estimate(tables)
         for key in expected:
-            if expected[key] != actual[key]:
+            if self.deviation(expected[key], actual[key]) > tolerance:
                 msg = "Verification failed for {}. " \
                       "Expected: {:,d}; Actual: {:,d}".format(
                     key, expected[key], actual[key]
@@ -90,6 +211,25 @@ class Aggregator:
             logging.debug("{} count OK".format(key))
         logging.info("All counts OK.")
 
+    def verify_partitions(self, baseline: str,
+                          restrict: Dict[str, List] = None,
+                          tolerance: float = 0.0):
+        """
+        Verifies per-partition counts, null ratios and checksums
+        of the tables against a baseline,
+        see :class:`cms.verification.Verifier`
+
+        :param baseline: Path to the baseline file
+        :param restrict: Dictionary mapping "state" and/or "year"
+            to the lists of values to verify
+        :param tolerance: Allowed difference in null ratios
+        """
+
+        profiles = [p for p in DEFAULT_PROFILES if p.table in self.tables]
+        verifier = Verifier(self.context.db, self.context.connection,
+                            profiles)
+        verifier.verify(baseline, restrict, tolerance)
+
 
 class ExpectedData:
     def __init__(self):
@@ -101,5 +241,35 @@ class ExpectedData:
         }
 
 
+def args():
+    parser = ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--tables", nargs='+',
+                        help="Qualified names of the tables to verify, "
+                             "by default: " + ", ".join(DEFAULT_TABLES))
+    parser.add_argument("--estimate", action='store_true',
+                        help="Compare planner estimates instead of "
+                             "counting rows exactly")
+    parser.add_argument("--tolerance", type=float,
+                        default=ESTIMATE_TOLERANCE,
+                        help="Allowed relative difference between "
+                             "estimated and expected numbers of rows")
+    return split_arguments(parser)
+
+
+def main():
+    arguments = args()
+    counts = ExpectedData().micro_random_counts
+    tables = arguments.tables if arguments.tables else list(counts)
+    unknown = [t for t in tables if t not in counts]
+    if unknown:
+        raise ValueError("No expected counts for: " + ", ".join(unknown))
+    aggregator = Aggregator(tables=tables)
+    aggregator.verify(
+        {t: counts[t] for t in tables},
+        exact=not arguments.estimate,
+        tolerance=arguments.tolerance
+    )
+
+
 if __name__ == '__main__':
-    Aggregator().verify(ExpectedData().micro_random_counts)
+    main()
@@ -0,0 +1,53 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Data loader for CSV files produced by CMS tools.
+
+Besides plain and gzipped files, understood by the generic
+data loader, it can read files compressed with Zstandard (`.zst`)
+or LZ4 (`.lz4`)
+"""
+
+from typing import List, Tuple, Any, Callable
+
+from nsaph.loader.data_loader import DataLoader
+
+from cms.tools.compression import codec_for, open_input, ZSTD, LZ4
+
+
+class CSVLoader(DataLoader):
+    """
+    Data loader, that can also read CSV files compressed
+    with zstd or lz4
+    """
+
+    def get_files(self) -> List[Tuple[Any, Callable]]:
+        files = []
+        for entry in super().get_files():
+            if isinstance(entry, tuple) and isinstance(entry[0], str) \
+                    and codec_for(entry[0]) in [ZSTD, LZ4]:
+                entry = (entry[0], open_input)
+            files.append(entry)
+        return files
+
+
+if __name__ == '__main__':
+    loader = CSVLoader(None)
+    loader.run()
@@ -71,9 +71,12 @@ Also, see: https://resdac.org/cms-data/variables/encrypted-723-ccw-beneficiary-i
 import gzip
 import json
 import os.path
+import queue
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import date, timedelta
-from typing import Dict
+from typing import Dict, List, Sequence, Optional, Iterator, Tuple
 
 from nsaph_utils.utils.io_utils import fopen
 
@@ -93,44 +96,122 @@ ORDER BY COUNT(*) desc
 '''
 
 
-EXPLORE_BENE = '''
+EXPLORE_BATCH = '''
 SELECT
     *
-FROM 
+FROM
     cms.ps
-WHERE bene_id = '{id}'    
+WHERE bene_id = ANY(%s)
+ORDER BY bene_id
+'''
+
+
+TABLE_COLUMNS = '''
+SELECT
+    column_name
+FROM
+    information_schema.columns
+WHERE table_schema = %s AND table_name = %s
+ORDER BY ordinal_position
 '''
 
 
+# A column differs if it has more than one distinct non-null value
+# or if it is null in some records but not in all of them
+DIFF_COLUMN = '''
+    CASE
+        WHEN COUNT(DISTINCT {c}) > 1
+            OR COUNT({c}) BETWEEN 1 AND COUNT(*) - 1
+        THEN array_agg({c})
+    END AS {c}'''
+
+
+DIFF_BATCH = '''
+SELECT
+    bene_id,{columns}
+FROM
+    cms.ps
+WHERE bene_id = ANY(%s)
+GROUP BY bene_id
+'''
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
 class DuplicatesExplorer:
+    """
+    Explores duplicate records in cms.ps table.
+
+    The report is a gzipped JSON Lines file, every line is an object
+    with `bene_id` and `columns` keys. The default name of the report
+    (`cms_ps_duplicates.json.gz`) is kept from older versions, that
+    wrote the report as a single JSON document; such report is
+    converted to JSON Lines when it is loaded. When the duplicates are found,
+    a line with null `columns` is written for every beneficiary.
+    Explored beneficiaries are appended with the columns that differ
+    between their records. The report is read lazily, hence only the
+    exploration status of beneficiaries is kept in memory
+    (`self.duplicates` maps bene_id to True if it has been explored).
+    """
+
     def __init__(self, arguments):
         self.arguments = arguments
         self.duplicates = None
         self.reset = arguments.reset
         self.duplicate_deaths = None
         self.duplicate_births = None
-        self.change = False
+        self.pending: Dict[str, Dict] = dict()
+
+    @property
+    def report_path(self) -> str:
+        fname = self.arguments.report
+        if not fname.endswith(".gz"):
+            fname += ".gz"
+        return fname
 
     def init (self):
         if self.duplicates is not None:
             return
-        if not self.reset and os.path.isfile(self.arguments.report):
+        if not self.reset and os.path.isfile(self.report_path):
             self.load()
             return
         with Connection(self.arguments.db, self.arguments.connection) as connection:
             with (connection.cursor()) as cursor:
                 print("Examining database {}".format(self.arguments.connection))
                 cursor.execute(FIND_DUPLICATES)
-                self.duplicates = {row[0]: None for row in cursor}
-            self.change = True
-        self.save()
+                self.duplicates = {row[0]: False for row in cursor}
+        with gzip.open(self.report_path, "wt") as f:
+            for bene_id in self.duplicates:
+                self.write_entry(f, bene_id, None)
         return
 
-    def explore_one(self, id, cursor):
-        sql = EXPLORE_BENE.format(id=id)
-        cursor.execute(sql)
-        all_columns = [desc[0] for desc in cursor.description]
-        data = [row for row in cursor]
+    @staticmethod
+    def write_entry(f, bene_id: str, columns: Optional[Dict]):
+        f.write(json.dumps({"bene_id": bene_id, "columns": columns}))
+        f.write('\n')
+
+    def add_reports(self, reports: Dict[str, Dict]):
+        """
+        Records explored beneficiaries. The reports are appended to
+        the report file by the next `save()`
+        """
+
+        self.pending.update(reports)
+        for bene_id in reports:
+            self.duplicates[bene_id] = True
+
+    @staticmethod
+    def diff(all_columns: List[str], data: Sequence[tuple]) -> Dict:
+        """
+        Finds columns that have different values in duplicate records
+
+        :param all_columns: Names of the columns
+        :param data: Duplicate records
+        :return: Dictionary mapping the names of differing columns
+            to the values in every record
+        """
+
         diff_columns = []
         for j in range(len(all_columns)):
             column = {row[j] for row in data}
@@ -141,19 +222,165 @@ class DuplicatesExplorer:
                 [str(row[j]) for row in data]
             for j in diff_columns
         }
-        self.duplicates[id] = report
-        self.change = True
+        return report
+
+    def explore_batch(self, ids: List[str], connection) -> Dict:
+        """
+        Explores a batch of beneficiaries with a single query. The rows
+        are streamed through a server side cursor ordered by bene_id,
+        and a report is built as soon as all rows of a beneficiary
+        have arrived.
+
+        :param ids: bene_id values
+        :param connection: Database connection
+        :return: Reports for the explored beneficiaries
+        """
+
+        reports = dict()
+        with connection.cursor(name="explore_duplicates") as cursor:
+            cursor.itersize = 10000
+            cursor.execute(EXPLORE_BATCH, (ids,))
+            all_columns = None
+            key = None
+            current = None
+            data = []
+            for row in cursor:
+                if all_columns is None:
+                    all_columns = [desc[0] for desc in cursor.description]
+                    key = all_columns.index("bene_id")
+                if row[key] != current:
+                    if data:
+                        reports[current] = self.diff(all_columns, data)
+                    current = row[key]
+                    data = []
+                data.append(row)
+            if data:
+                reports[current] = self.diff(all_columns, data)
+        return reports
+
+    @staticmethod
+    def diff_sql(columns: List[str]) -> str:
+        """
+        Generates a query that finds differing columns on the server:
+        for every beneficiary it returns all values of the columns
+        that differ between duplicate records and nulls for
+        the columns that are the same
+
+        :param columns: Names of the columns of cms.ps table
+        :return: SQL query, parameterized by an array of bene_ids
+        """
+
+        aggregates = [
+            DIFF_COLUMN.format(c='"{}"'.format(c.replace('"', '""')))
+            for c in columns if c != "bene_id"
+        ]
+        return DIFF_BATCH.format(columns=','.join(aggregates))
+
+    @staticmethod
+    def table_columns(connection, schema: str = "cms",
+                      table: str = "ps") -> List[str]:
+        with connection.cursor() as cursor:
+            cursor.execute(TABLE_COLUMNS, (schema, table))
+            return [row[0] for row in cursor]
+
+    def explore_batch_on_server(self, ids: List[str], connection,
+                                sql: str) -> Dict:
+        """
+        Explores a batch of beneficiaries, finding differing columns
+        in the database. Only the values of the differing columns
+        are transferred.
+
+        :param ids: bene_id values
+        :param connection: Database connection
+        :param sql: Query generated by `diff_sql()`
+        :return: Reports for the explored beneficiaries
+        """
+
+        reports = dict()
+        with connection.cursor(name="diff_duplicates") as cursor:
+            cursor.itersize = 1000
+            cursor.execute(sql, (ids,))
+            all_columns = None
+            for row in cursor:
+                if all_columns is None:
+                    all_columns = [desc[0] for desc in cursor.description]
+                reports[row[0]] = {
+                    all_columns[j]: [str(v) for v in row[j]]
+                    for j in range(1, len(row)) if row[j] is not None
+                }
+        return reports
+
+    def explore_pooled(self, pool: queue.Queue, ids: List[str],
+                       sql: Optional[str]) -> Dict:
+        """
+        Explores a batch of beneficiaries using a connection
+        borrowed from a pool
+        """
+
+        connection = pool.get()
+        try:
+            if sql:
+                return self.explore_batch_on_server(ids, connection, sql)
+            return self.explore_batch(ids, connection)
+        finally:
+            pool.put(connection)
 
     def explore_all(self):
-        with Connection(self.arguments.db, self.arguments.connection) as connection:
-            with (connection.cursor()) as cursor:
+        """
+        Explores all beneficiaries that are not yet in the report.
+        Batches are distributed between worker threads, each using
+        a connection from a pool. The results are merged by the main
+        thread and the report is saved every `checkpoint` batches,
+        so that an interrupted run can be resumed.
+        """
+
+        batch_size = getattr(self.arguments, "batch", None) \
+                     or DEFAULT_BATCH_SIZE
+        workers = getattr(self.arguments, "workers", None) or 1
+        checkpoint = getattr(self.arguments, "checkpoint", None)
+        on_server = getattr(self.arguments, "server_diff", False)
+        pending = [
+            bene_id for bene_id in self.duplicates
+            if not self.duplicates[bene_id]
+        ]
+        batches = [
+            pending[i:i + batch_size]
+            for i in range(0, len(pending), batch_size)
+        ]
+        if not batches:
+            return
+        workers = min(workers, len(batches))
+        with ExitStack() as stack:
+            pool = queue.Queue()
+            for _ in range(workers):
+                pool.put(stack.enter_context(
+                    Connection(self.arguments.db, self.arguments.connection)
+                ))
+            sql = None
+            if on_server:
+                connection = pool.get()
+                sql = self.diff_sql(self.table_columns(connection))
+                pool.put(connection)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self.explore_pooled, pool, batch, sql)
+                    for batch in batches
+                ]
                 n = 0
-                for bene_id in self.duplicates:
-                    if not self.duplicates[bene_id]:
-                        self.explore_one(bene_id, cursor)
-                        n += 1
-                        if (n % 100) == 0:
-                            print(n)
+                try:
+                    for i, future in enumerate(as_completed(futures), 1):
+                        reports = future.result()
+                        self.add_reports(reports)
+                        n += len(reports)
+                        print("{:d}/{:d}".format(n, len(pending)))
+                        if checkpoint and i % checkpoint == 0:
+                            self.save()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    self.save()
+                    raise
+        self.save()
 
     def is_loaded(self):
         if self.duplicates is None:
@@ -163,17 +390,70 @@ class DuplicatesExplorer:
                 return False
         return True
 
+    def entries(self) -> Iterator[Tuple[str, Optional[Dict]]]:
+        """
+        Reads the report lazily
+
+        :return: Iterator over tuples (bene_id, differing columns),
+            the columns are None for beneficiaries that have not
+            been explored
+        """
+
+        with fopen(self.report_path, "rt") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    yield entry["bene_id"], entry["columns"]
+
+    def records(self) -> Iterator[Tuple[str, Dict]]:
+        """
+        Iterates over explored beneficiaries in the report
+        """
+
+        for bene_id, columns in self.entries():
+            if columns is not None:
+                yield bene_id, columns
+
+    def is_legacy(self) -> bool:
+        """
+        Checks if the report is a single JSON document, written by
+        older versions
+        """
+
+        with fopen(self.report_path, "rt") as f:
+            line = f.readline()
+        if not line.strip():
+            return False
+        try:
+            return "bene_id" not in json.loads(line)
+        except ValueError:
+            return True
+
+    def convert_legacy(self):
+        with fopen(self.report_path, "rt") as f:
+            content = json.load(f)
+        tmp = self.report_path + ".tmp"
+        with gzip.open(tmp, "wt") as f:
+            for bene_id in content:
+                self.write_entry(f, bene_id, content[bene_id] or None)
+        os.replace(tmp, self.report_path)
+
     def load(self):
-        with fopen(self.arguments.report, "rt") as f:
-            self.duplicates = json.load(f)
+        if self.is_legacy():
+            self.convert_legacy()
+        self.duplicates = dict()
+        for bene_id, columns in self.entries():
+            self.duplicates[bene_id] = \
+                self.duplicates.get(bene_id, False) or columns is not None
 
     def save(self):
-        fname = self.arguments.report
-        if not fname.endswith(".gz"):
-            fname += ".gz"
-        if self.change:
-            with gzip.open(fname, "wt") as f:
-                json.dump(self.duplicates, f, indent=2)
+        fname = self.report_path
+        if self.pending:
+            # every append adds a new gzip member to the file
+            with gzip.open(fname, "at") as f:
+                for bene_id, columns in self.pending.items():
+                    self.write_entry(f, bene_id, columns)
+            self.pending = dict()
         name = '.'.join(fname.split('.')[:-2])
         if self.duplicate_births is not None:
             with open(name + "_births.json", "wt") as f:
@@ -187,39 +467,45 @@ class DuplicatesExplorer:
         print("Found {:d} duplicates.".format(len(self.duplicates)))
         if self.reset or not self.is_loaded():
             self.explore_all()
+            self.save()
         self.duplicate_deaths = self.find_duplicate_dates("el_dod")
         self.duplicate_births = self.find_duplicate_dates("el_dob")
         self.save()
 
-    def find_duplicate_dates(self, date_type) -> Dict:
+    def duplicate_dates(self, date_type) -> Iterator[Tuple[str, Dict]]:
+        """
+        Streaming pass over the report, yielding beneficiaries
+        with inconsistent dates of a given type
+        """
+
         if date_type == "el_dod":
             keep_none = False
         else:
             keep_none = True
-        report = dict()
-        for bene_id in self.duplicates:
-            columns = self.duplicates[bene_id]
+        for bene_id, columns in self.records():
             if date_type in columns:
                 dates = columns[date_type]
                 date_range = sorted({d for d in dates if keep_none or d != "None"})
                 if len(date_range) < 2:
                     continue
-                report[bene_id] = dict()
-                report[bene_id]["range"] = [d for d in date_range]
-                report[bene_id]["MSIS"] = {
+                entry = dict()
+                entry["range"] = [d for d in date_range]
+                entry["MSIS"] = {
                     columns["msis_id"][i]: dates[i]
                     for i in range(len(dates))
                 }
-        return report
+                yield bene_id, entry
+
+    def find_duplicate_dates(self, date_type) -> Dict:
+        return dict(self.duplicate_dates(date_type))
 
     def analyze_inconsistent_age(self):
         self.init()
-        report = self.find_duplicate_dates("el_dob")
         max_delta = timedelta()
         max_bene = None
         num_age = 0
-        for bene_id in report:
-            dates = sorted([date.fromisoformat(d) for d in report[bene_id]["range"] if d != "None"])
+        for bene_id, entry in self.duplicate_dates("el_dob"):
+            dates = sorted([date.fromisoformat(d) for d in entry["range"] if d != "None"])
             if len(dates) < 2:
                 continue
             delta = dates[-1] - dates[0]
@@ -253,11 +539,25 @@ def args():
                         default="nsaph2",
                         required=False)
     parser.add_argument("--report",
-                        help="Path to a duplicates report file",
+                        help="Path to a duplicates report file "
+                             "(gzipped JSON Lines)",
                         default="cms_ps_duplicates.json.gz",
                         required=False)
     parser.add_argument("--reset", action='store_true',
                         help="Force recreating duplicate report if it already exists")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of beneficiaries explored by "
+                             "a single query")
+    parser.add_argument("--server-diff", action='store_true',
+                        dest="server_diff",
+                        help="Find differing columns in the database, "
+                             "transferring only their values")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of database connections used "
+                             "in parallel")
+    parser.add_argument("--checkpoint", type=int, default=10,
+                        help="Save the report every given number "
+                             "of batches")
     parser.add_argument("--action", default="report",
                         help="Force recreating duplicate report if it already exists")
 
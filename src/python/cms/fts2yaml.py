@@ -26,9 +26,13 @@ extract metadata
 """
 
 
-import glob
+import fnmatch
+import hashlib
+import inspect
 import os
-from typing import List, Optional, Dict
+import pickle
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Tuple, Callable
 
 import yaml
 
@@ -63,6 +67,182 @@ def mcr_type(file_name: str) -> str:
     raise ValueError("Unsupported Medicare file type: " + file_name)
 
 
+FTS_CACHE_ENV = "CMS_FTS_CACHE"
+'''Environment variable defining the directory for cached FTS files,
+    "none" disables the cache'''
+
+
+class FTSCache:
+    """
+    On-disk cache of parsed FTS files.
+
+    An entry is keyed by the path of an FTS file and the type of
+    its columns. It is used while the file has the same modification
+    time and size, or, if these have changed, the same content, and
+    while the source code of the parser has not changed.
+    Parsed columns and metadata are stored as pickle files.
+    """
+
+    VERSION = 2
+    _code_digests: Dict[str, str] = dict()
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    @classmethod
+    def default(cls) -> Optional['FTSCache']:
+        directory = os.environ.get(FTS_CACHE_ENV)
+        if directory is None:
+            directory = os.path.join(
+                os.path.expanduser("~"), ".cache", "nsaph_cms", "fts"
+            )
+        elif directory.strip().lower() in ["", "none", "off"]:
+            return None
+        return FTSCache(directory)
+
+    @staticmethod
+    def digest(path: str) -> str:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @classmethod
+    def code_digest(cls, *objects) -> str:
+        """
+        Digest of the source files of the modules, defining
+        the given classes or functions
+        """
+
+        h = hashlib.sha256()
+        for obj in objects:
+            source = inspect.getsourcefile(obj)
+            if source not in cls._code_digests:
+                cls._code_digests[source] = cls.digest(source)
+            h.update(cls._code_digests[source].encode("utf-8"))
+        return h.hexdigest()
+
+    def entry_path(self, path: str, kind: str) -> str:
+        key = "{}:{}".format(os.path.abspath(path), kind)
+        return os.path.join(
+            self.directory,
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle"
+        )
+
+    def load(self, entry_path: str) -> Optional[dict]:
+        try:
+            with open(entry_path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, AttributeError):
+            return None
+        if not isinstance(entry, dict) or \
+                entry.get("version") != self.VERSION:
+            return None
+        return entry
+
+    def store(self, entry_path: str, entry: dict):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = "{}.{:d}.tmp".format(entry_path, os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, entry_path)
+        except OSError:
+            # Cache is optional, e.g. home directory can be read-only
+            pass
+
+    def get(self, path: str, kind: str, parse: Callable[[str], tuple],
+            code: str = None):
+        """
+        Returns parsed content of a file, either from the cache
+        or by parsing the file
+
+        :param path: Path to FTS file
+        :param kind: Type of the parsed objects
+        :param parse: Function parsing the file
+        :param code: Digest of the parser source code, entries
+            created by a different parser are ignored
+        :return: Parsed content, as returned by `parse`
+        """
+
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        entry_path = self.entry_path(path, kind)
+        entry = self.load(entry_path)
+        if entry is not None and entry.get("code") != code:
+            entry = None
+        if entry is not None and entry["stamp"] == stamp:
+            return entry["value"]
+        digest = self.digest(path)
+        if entry is not None and entry["digest"] == digest:
+            value = entry["value"]
+        else:
+            value = parse(path)
+        self.store(entry_path, {
+            "version": self.VERSION,
+            "code": code,
+            "stamp": stamp,
+            "digest": digest,
+            "value": value
+        })
+        return value
+
+
+def list_dir(path: str) -> Tuple[List[str], List[str]]:
+    """
+    Lists a directory, skipping hidden entries the same way as glob does
+
+    :param path: directory
+    :return: tuple (files, subdirectories)
+    """
+
+    files = []
+    dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                dirs.append(entry.path)
+            else:
+                files.append(entry.path)
+    return files, dirs
+
+
+def find_files(root: str, pattern: str, depth: int = None,
+               threads: int = None) -> List[str]:
+    """
+    Finds files in a directory tree. Directories are listed
+    concurrently by a pool of threads, what is much faster
+    than glob on network file systems.
+
+    :param root: Root directory
+    :param pattern: Pattern (as used by glob) for file names
+    :param depth: If specified, only files exactly `depth` levels
+        below the root are returned, like glob does with
+        a non-recursive pattern. Otherwise, files at any level
+        are returned, like recursive glob with `**` does
+    :param threads: Number of threads listing directories
+    :return: sorted list of file paths
+    """
+
+    found = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(list_dir, root): 0}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                level = pending.pop(future)
+                files, dirs = future.result()
+                if depth is None or level == depth:
+                    found.extend(
+                        f for f in files
+                        if fnmatch.fnmatch(os.path.basename(f), pattern)
+                    )
+                if depth is None or level < depth:
+                    for d in dirs:
+                        pending[executor.submit(list_dir, d)] = level + 1
+    return sorted(found)
+
+
 def width(s:str):
     if '.' in s:
         x = s.split('.')
@@ -306,6 +486,8 @@ class CMSFTS:
                 ORIGINAL_FILE_COLUMN
             ]
 
+    cache: Optional[FTSCache] = FTSCache.default()
+
     def __init__(self, type_of_data: str):
         """
 
@@ -315,7 +497,7 @@ class CMSFTS:
 
         self.table_type = type_of_data.lower()
         self.table_name = None
-        self.indices = self.common_indices
+        self.indices = list(self.common_indices)
         self.columns: List[FTSColumn] = []
         self.pk = None
         self.constructor = None
@@ -327,6 +509,42 @@ class CMSFTS:
         pass
 
     def read_file(self, f):
+        metadata, columns = self.parse_file(f)
+        self.reconcile(f, metadata, columns)
+
+    def read_files(self, files: List[str], threads: int = None):
+        """
+        Reads several FTS files describing the same table. The files
+        are parsed in parallel threads and then reconciled in the
+        given order, exactly as by consecutive calls to `read_file`
+
+        :param files: FTS files
+        :param threads: Number of threads
+        """
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            parsed = list(executor.map(self.parse_file, files))
+        for f, (metadata, columns) in zip(files, parsed):
+            self.reconcile(f, metadata, columns)
+
+    def parse_file(self, f) -> Tuple[Dict[str, str], List[FTSColumn]]:
+        """
+        Parses an FTS file without changing the state of this object,
+        hence several files can be parsed concurrently. If the file
+        has been parsed before, the result is taken from the cache
+
+        :param f: FTS file
+        :return: tuple (metadata, columns)
+        """
+
+        if self.cache is None:
+            return self.parse_text(f)
+        code = self.cache.code_digest(type(self), self.constructor)
+        return self.cache.get(f, self.constructor.__name__, self.parse_text,
+                              code)
+
+    def parse_text(self, f) -> Tuple[Dict[str, str], List[FTSColumn]]:
+        metadata = dict()
         with fopen(f, "rt") as fts:
             lines = [line for line in fts]
         i = 0
@@ -338,7 +556,7 @@ class CMSFTS:
                 break
             if ':' in line:
                 x = line.split(':', 1)
-                self.metadata[x[0].strip()] = x[1].strip()
+                metadata[x[0].strip()] = x[1].strip()
             continue
 
         if 1 > i or i > len(lines) - 2:
@@ -356,7 +574,20 @@ class CMSFTS:
                 break
             column = column_reader.read(line)
             columns.append(column)
+        return metadata, columns
+
+    def reconcile(self, f, metadata: Dict[str, str],
+                  columns: List[FTSColumn]):
+        """
+        Adds a parsed FTS file to this object, checking that it
+        describes the same columns as previously read files
 
+        :param f: FTS file
+        :param metadata: metadata, as returned by `parse_file`
+        :param columns: columns, as returned by `parse_file`
+        """
+
+        self.metadata.update(metadata)
         self.on_after_read_file(columns)
         if not self.columns:
             self.columns = columns
@@ -527,6 +758,7 @@ class MedicaidFTS(CMSFTS):
         self.constructor = MedicaidFTSColumn
         assert self.table_type in ["ps", "ip"]
         self.pattern = "**/maxdata_{}_*.fts".format(type_of_data)
+        self.threads = None
         self.indices += self.medicaid_indices
         if self.table_type == "ps":
             year_column = "MAX_YR_DT"
@@ -539,13 +771,12 @@ class MedicaidFTS(CMSFTS):
             self.indices += ["MSIS_ID", "STATE_CD", year_column, "RECORD"]
 
     def init(self, path: str = None):
-        if path is not None:
-            pattern = os.path.join(path, self.pattern)
-        else:
-            pattern = self.pattern
-        files = glob.glob(pattern)
-        for file in files:
-            self.read_file(file)
+        if path is None:
+            path = os.curdir
+        # Non-recursive pattern: files one level below the path
+        _, name_pattern = os.path.split(self.pattern)
+        files = find_files(path, name_pattern, depth=1, threads=self.threads)
+        self.read_files(files, self.threads)
         return self
 
     def on_after_read_file(self, columns: List[FTSColumn]):
@@ -21,8 +21,50 @@ import os
 from typing import List, Tuple, Any, Callable
 
 from cms.fts2yaml import mcr_type, MedicareFTS
+from cms.tools.mcr_copy import DatCopyLoader
+from cms.tools.mcr_dat import DatReader
+from cms.tools.mcr_file import RecordDecoder, MedparParseException, log
+from cms.tools.options import split_arguments, loader_parser
 from nsaph.loader.data_loader import DataLoader
-from nsaph_utils.utils.fwf import FWFReader
+from nsaph_utils.utils.fwf import FWFReader, FWFMeta
+
+
+class MmapFWFReader(FWFReader):
+    """
+    Reader for fixed width files, that maps the file into memory and
+    decodes records directly from the mapped pages, without
+    copying them
+    """
+
+    def __init__(self, meta: FWFMeta):
+        super().__init__(meta)
+        self.dat_path = meta.path
+        self.record_len = meta.record_len
+        self.decoder = RecordDecoder(meta.columns)
+        self.reader = None
+        self.ln = 0
+
+    def __enter__(self):
+        self.reader = DatReader(self.dat_path, self.record_len).open()
+        self.ln = 0
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reader.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            data = next(self.reader)
+            self.ln += 1
+            try:
+                return self.decoder.decode(data, self.ln)
+            except MedparParseException as x:
+                log("Line = " + str(self.ln) + ':' + str(x.pos))
+                log(x)
+                self.reader.resync(x.pos)
 
 
 class MedicareDataLoader(DataLoader):
@@ -34,7 +76,8 @@ class MedicareDataLoader(DataLoader):
         return data_files
 
     @classmethod
-    def open(cls, name: str, dat_path: str = None) -> FWFReader:
+    def open(cls, name: str, dat_path: str = None,
+             memory_map: bool = False) -> FWFReader:
         f, ext = os.path.splitext(name)
         if dat_path is not None:
             assert ext.lower() == '.fts'
@@ -51,20 +94,61 @@ class MedicareDataLoader(DataLoader):
         basedir, fname = os.path.split(f)
         t = mcr_type(fname)
         fts = MedicareFTS(t).init(fts_path)
+        if memory_map:
+            return MmapFWFReader(fts.to_fwf_meta(dat_path))
         return FWFReader(fts.to_fwf_meta(dat_path))
 
-    def __init__(self, context):
+    def __init__(self, context, memory_map: bool = False,
+                 copy_format: str = None):
+        """
+        :param context: Loader configuration
+        :param memory_map: Read DAT files through memory mapping
+        :param copy_format: If specified ("text" or "binary"), records
+            are streamed into the table with parallel COPY commands
+            instead of being inserted by the data loader. The number
+            of copied records is then available as `copied`
+        """
+
+        self.memory_map = memory_map
+        self.copy_format = copy_format
+        self.copied = None
         super().__init__(context)
 
+    def run(self):
+        super().run()
+        if not self.copy_format:
+            return
+        table = "{}.{}".format(self.context.domain, self.context.table)
+        self.copied = 0
+        for fts_path in self.context.data:
+            stats = DatCopyLoader(
+                fts_path,
+                self.context.db,
+                self.context.connection,
+                table=table,
+                workers=self.context.threads,
+                copy_format=self.copy_format
+            ).run()
+            if stats is not None:
+                self.copied += stats.records
+
     def get_files(self) -> List[Tuple[Any, Callable]]:
+        if self.copy_format:
+            # Table is created by the data loader, while the data
+            # is copied by DatCopyLoader after the loader has finished
+            return []
         objects = []
         for fts_path in self.context.data:
             dat_files = self.dat4fts(fts_path)
             for dat_file in dat_files:
-                objects.append(self.open(fts_path, dat_file))
+                objects.append(
+                    self.open(fts_path, dat_file, self.memory_map)
+                )
         return objects
 
 
 if __name__ == '__main__':
-    loader = MedicareDataLoader(None)
+    options = split_arguments(loader_parser())
+    loader = MedicareDataLoader(None, memory_map=options.memory_map,
+                                copy_format=options.copy_format)
     loader.run()
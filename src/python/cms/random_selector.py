@@ -23,28 +23,253 @@ outputs the selected lines
 #  limitations under the License.
 #
 
-import gzip
 from argparse import ArgumentParser
 
-import sys
-
+import csv
+import hashlib
+import heapq
 import os
 import glob
 import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, List, Iterator
 
-from nsaph_utils.utils.io_utils import fopen
+from cms.tools.compression import open_output, open_input, codec_for, \
+    threads_per_worker, GZIP, CODECS
 
 
 SEED = 1
+HASH_SCALE = float(2 ** 64)
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class Sampler:
+    """
+    Selects lines from a file.
+
+    Without a key column, every line is selected with a given
+    probability, using a random generator seeded by the file name,
+    so that the result does not depend on the order in which
+    the files are processed.
+
+    With a key column (e.g. BENE_ID), a line is selected if a stable
+    hash of the key is below the threshold, hence the same
+    beneficiaries are selected from all files and years.
+
+    If the sample size is given, the lines with the smallest hashes
+    (of the key or of the whole line) are selected (bottom-k sampling),
+    which is a deterministic equivalent of reservoir sampling.
+    """
+
+    def __init__(self, threshold: float, key: str = None,
+                 delimiter: str = ',', size: int = None, seed: int = SEED,
+                 threads: int = None):
+        """
+        :param threshold: Share of lines to be selected
+        :param key: Name of the key column, if the files have a header,
+            or 0-based index of the key column
+        :param delimiter: Column delimiter
+        :param size: Fixed number of lines to select from each file
+        :param seed: Seed for hashing and random generator
+        :param threads: Number of compression threads for every
+            output file
+        """
+
+        self.threshold = threshold
+        self.key = key
+        self.delimiter = delimiter
+        self.size = size
+        self.seed = seed
+        self.salt = str(seed).encode("utf-8")
+        self.threads = threads
+
+    def hash(self, value: bytes) -> float:
+        """
+        Stable hash of a value, uniformly distributed in [0, 1)
+        """
+
+        digest = hashlib.blake2b(
+            value, digest_size=8, key=self.salt
+        ).digest()
+        return int.from_bytes(digest, "big") / HASH_SCALE
+
+    def key_index(self, header: Optional[bytes]) -> int:
+        if self.key.isdigit():
+            return int(self.key)
+        fields = self.split(header)
+        try:
+            return [
+                f.strip().lower() for f in fields
+            ].index(self.key.lower().encode("utf-8"))
+        except ValueError:
+            raise ValueError("Key column {} is not found in the header"
+                             .format(self.key))
+
+    def key_hash(self, line, index: int) -> Optional[float]:
+        """
+        Hash of the key column of a line. Padding and quotes around
+        the key are ignored, so that the same key gets the same hash
+        in files of different formats
+
+        :return: The hash or None if the line is blank or does not
+            have the key column
+        """
+
+        fields = self.split(line)
+        if index >= len(fields):
+            return None
+        key = fields[index].strip().strip(b'"').strip()
+        if not key:
+            return None
+        return self.hash(key)
+
+    def split(self, line) -> List[bytes]:
+        line = bytes(line).rstrip(b"\r\n")
+        if b'"' in line:
+            fields = next(csv.reader(
+                [line.decode("utf-8")], delimiter=self.delimiter
+            ))
+            return [f.encode("utf-8") for f in fields]
+        return line.split(self.delimiter.encode("utf-8"))
+
+    def has_header(self) -> bool:
+        return self.key is not None and not self.key.isdigit()
+
+    @staticmethod
+    def lines(src, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+            -> Iterator[memoryview]:
+        """
+        Reads a binary stream in large chunks and splits them
+        into lines without copying
+
+        :param src: Input binary stream
+        :param chunk_size: Number of bytes read at once
+        :return: Iterator over lines, including line terminators,
+            as memoryview slices of the chunks
+        """
+
+        tail = b''
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            buffer = tail + chunk if tail else chunk
+            view = memoryview(buffer)
+            start = 0
+            while True:
+                i = buffer.find(b'\n', start)
+                if i < 0:
+                    break
+                yield view[start:i + 1]
+                start = i + 1
+            tail = bytes(view[start:])
+            view.release()
+        if tail:
+            yield memoryview(tail)
+
+    def sample(self, src, output, name: str) -> Tuple[int, int, int]:
+        """
+        Copies selected lines from src to output. The lines are
+        neither decoded nor encoded, only the key column is parsed
+        if needed. Lines without the key are skipped.
 
+        :param src: Input binary stream
+        :param output: Output binary stream
+        :param name: Name of the file, used to seed random generator
+        :return: Number of lines read, number of lines selected and
+            number of lines skipped because they have no key
+        """
+
+        n1 = 0
+        n2 = 0
+        skipped = 0
+        index = None
+        lines = self.lines(src)
+        if self.has_header():
+            header = next(lines, None)
+            if header is None:
+                return 0, 0, 0
+            output.write(header)
+            index = self.key_index(header)
+        elif self.key is not None:
+            index = self.key_index(None)
+        if self.size:
+            heap = []
+            for line in lines:
+                n1 += 1
+                if index is not None:
+                    h = self.key_hash(line, index)
+                    if h is None:
+                        skipped += 1
+                        continue
+                else:
+                    h = self.hash(line)
+                if len(heap) < self.size:
+                    heapq.heappush(heap, (-h, -n1, bytes(line)))
+                elif (-h, -n1) > heap[0][:2]:
+                    heapq.heapreplace(heap, (-h, -n1, bytes(line)))
+            for _, _, line in sorted(heap, key=lambda i: -i[1]):
+                output.write(line)
+                n2 += 1
+        elif index is not None:
+            for line in lines:
+                n1 += 1
+                h = self.key_hash(line, index)
+                if h is None:
+                    skipped += 1
+                elif h < self.threshold:
+                    output.write(line)
+                    n2 += 1
+        else:
+            generator = random.Random("{}:{}".format(self.seed, name))
+            for line in lines:
+                n1 += 1
+                if generator.random() < self.threshold:
+                    output.write(line)
+                    n2 += 1
+        return n1, n2, skipped
+
+    def sample_file(self, src_path: str, dest_path: str) -> str:
+        name = os.path.join(
+            os.path.basename(os.path.dirname(src_path)),
+            os.path.basename(src_path)
+        )
+        with open_input(src_path, "rb") as src, \
+                open_output(dest_path, "wb", threads=self.threads) as output:
+            n1, n2, skipped = self.sample(src, output, name)
+        msg = "{} ==> {}: {:d}/{:d}".format(src_path, dest_path, n2, n1)
+        if skipped:
+            msg += "; {:d} lines without key skipped".format(skipped)
+        return msg
+
+
+def select(pattern: str, destination: str, threshold: float,
+           key: str = None, size: int = None, delimiter: str = ',',
+           workers: int = 1, codec: str = GZIP):
+    """
+    Selects lines from files matching a pattern
+
+    :param pattern: Pattern to select incoming files
+    :param destination: Directory to output the selection
+    :param threshold: Share of lines to select
+    :param key: Key column (name or 0-based index), if given,
+        the lines are selected by the hash of the key
+    :param size: Fixed number of lines to select from each file
+    :param delimiter: Column delimiter
+    :param workers: Number of files processed in parallel processes
+    :param codec: Compression of the output files: gz, zst or lz4
+    """
 
-def select(pattern: str, destination: str, threshold: float):
     files = glob.glob(pattern)
-    random.seed(SEED)
+    # files are compressed by several processes at the same time
+    sampler = Sampler(threshold, key, delimiter, size,
+                      threads=threads_per_worker(workers))
+    tasks = []
     for f in files:
         name = os.path.basename(f)
-        if not name.endswith('.gz'):
-            name += ".gz"
+        if codec_for(name):
+            name = name.rsplit('.', 1)[0]
+        name += "." + codec
         dest = os.path.basename(os.path.dirname(f))
         dest = os.path.join(destination, dest)
         if not os.path.isdir(dest):
@@ -53,17 +278,17 @@ def select(pattern: str, destination: str, threshold: float):
         if os.path.isfile(dest):
             print("Skipping: {}".format(f))
             continue
-        print("{} ==> {}".format(f, dest))
+        tasks.append((f, dest))
 
-        with fopen(f, "rt") as src, gzip.open(dest, "wt") as output:
-            n1 = 0
-            n2 = 0
-            for line in src:
-                n1 += 1
-                if random.random() < threshold:
-                    output.write(line)
-                    n2 += 1
-        print("{:d}/{:d}".format(n2, n1))
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for msg in executor.map(sampler.sample_file,
+                                    [t[0] for t in tasks],
+                                    [t[1] for t in tasks]):
+                print(msg)
+    else:
+        for f, dest in tasks:
+            print(sampler.sample_file(f, dest))
     print("All Done")
 
 
@@ -84,11 +309,31 @@ def args():
                         default=0.02,
                         type=float,
                         required=False)
+    parser.add_argument("--key",
+                        help="Key column (name or 0-based index), "
+                             "if specified, the lines are selected by "
+                             "a stable hash of the key, e.g. BENE_ID",
+                        required=False)
+    parser.add_argument("--size", type=int,
+                        help="Select a fixed number of lines from "
+                             "each file, instead of a share",
+                        required=False)
+    parser.add_argument("--delimiter", default=',',
+                        help="Column delimiter",
+                        required=False)
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of files processed in parallel",
+                        required=False)
+    parser.add_argument("--codec", default=GZIP,
+                        choices=list(CODECS),
+                        help="Compression of the output files",
+                        required=False)
     arguments = parser.parse_args()
     return arguments
 
 
 if __name__ == '__main__':
     arg = args()
-    select(arg.input, arg.out, arg.selector)
+    select(arg.input, arg.out, arg.selector, key=arg.key, size=arg.size,
+           delimiter=arg.delimiter, workers=arg.workers, codec=arg.codec)
 
@@ -39,14 +39,15 @@ Sample user request: https://github.com/NSAPH/data_requests/tree/master/request_
 #  limitations under the License.
 #
 
+import copy
+import logging
 import os
 from pathlib import Path
-from typing import Dict
-
-import yaml
+from typing import Dict, List
 
 from cms.create_schema_config import CMSSchema
 from cms.fts2yaml import MedicaidFTS, MedicareFTS, mcr_type
+from cms.tools.yaml_io import read_registry, write_registry
 from nsaph import init_logging
 
 
@@ -58,25 +59,44 @@ class Registry:
     the model to a designated path
     """
 
-    def __init__(self, context: CMSSchema = None):
+    def __init__(self, context: CMSSchema = None, fts: MedicareFTS = None):
+        """
+        :param context: Configuration
+        :param fts: Medicare FTS file, that has been already parsed,
+            if not given the file is read from `context.input`
+        """
+
         if not context:
             init_logging()
             context = CMSSchema(__doc__).instantiate()
         self.context = context
+        self.fts = fts
         self.registry = None
         self.name = "cms"
 
-    def update(self):
+    def registry_path(self) -> str:
         if self.context.output is None:
-            registry_path = self.built_in_registry_path()
-        else:
-            registry_path = self.context.output
+            return self.built_in_registry_path()
+        return self.context.output
 
+    def load(self):
+        registry_path = self.registry_path()
         if (not self.context.reset) and os.path.isfile(registry_path):
-            with open(registry_path) as f:
-                self.registry = yaml.safe_load(f)
+            self.registry = read_registry(registry_path)
         else:
             self.init()
+
+    def save(self):
+        """
+        Writes the registry atomically: to a temporary file, that
+        then replaces the registry
+        """
+
+        write_registry(self.registry_path(), self.registry)
+
+    def update(self):
+        self.load()
+        original = copy.deepcopy(self.registry)
         if self.context.type == "medicaid":
             self.update_medicaid()
         elif self.context.type == "medicare":
@@ -84,10 +104,41 @@ class Registry:
         else:
             raise ValueError("Unknown data type: " + self.context.type)
 
-        with open(registry_path, "wt") as f:
-            f.write(yaml.dump(self.registry))
+        if self.registry == original \
+                and os.path.isfile(self.registry_path()):
+            # Nothing has changed, no need to rewrite the registry
+            return
+        self.save()
         return
 
+    def update_batch(self, schemas: List[MedicareFTS]) -> List[MedicareFTS]:
+        """
+        Adds tables described by several Medicare FTS files,
+        reading and writing the registry only once. A table that
+        cannot be converted into the data model is reported and
+        skipped, the other tables are still added
+
+        :param schemas: Parsed FTS files
+        :return: FTS files, whose tables have not been added
+        """
+
+        self.load()
+        original = copy.deepcopy(self.registry)
+        domain = self.registry[self.name]
+        failed = []
+        for fts in schemas:
+            try:
+                domain["tables"].update(fts.to_dict())
+            except Exception:
+                logging.exception("Error adding {} to the registry. "
+                                  "Ignoring.".format(fts.table_name))
+                failed.append(fts)
+        if self.registry == original \
+                and os.path.isfile(self.registry_path()):
+            return failed
+        self.save()
+        return failed
+
     def init(self):
         domain = {
             self.name: {
@@ -126,7 +177,10 @@ class Registry:
         f = self.context.input
         basedir, fts = os.path.split(f)
         t = mcr_type(fts)
-        table = MedicareFTS(t).init(f).to_dict()
+        if self.fts is not None:
+            table = self.fts.to_dict()
+        else:
+            table = MedicareFTS(t).init(f).to_dict()
         domain["tables"].update(table)
 
     @staticmethod
@@ -0,0 +1,278 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Compressed output for CSV files.
+
+The format is selected by the file extension:
+
+* `.gz` - gzip, compressed by a pool of threads. The data is split
+  into blocks that are deflated independently (like pigz does) and
+  written as a single standard gzip member
+* `.zst` - Zstandard, requires `zstandard` package
+* `.lz4` - LZ4 frame, requires `lz4` package
+
+Any other extension means no compression.
+
+If an exception is raised while a compressed file opened with
+`open_output` is written in a `with` block, the incomplete file is
+removed, so that it cannot be mistaken for a complete one.
+"""
+
+import gzip
+import io
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from nsaph_utils.utils.io_utils import fopen
+
+
+GZIP = "gz"
+ZSTD = "zst"
+LZ4 = "lz4"
+CODECS = [GZIP, ZSTD, LZ4]
+
+
+def threads_per_worker(workers: int = None) -> int:
+    """
+    Number of compression threads for each of several processes
+    (or threads), writing compressed files at the same time,
+    so that together they do not use more threads than CPUs
+    """
+
+    cpus = os.cpu_count() or 1
+    if not workers or workers < 2:
+        return cpus
+    return max(1, cpus // workers)
+
+
+def codec_for(path: str):
+    """
+    Returns compression format for a given file name
+    """
+
+    ext = path.rsplit('.', 1)[-1].lower()
+    if ext in CODECS:
+        return ext
+    return None
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Writes gzip file, compressing blocks of data in parallel threads.
+
+    Every block is compressed by a separate compressor and flushed
+    to a byte boundary, so that the compressed blocks can be simply
+    concatenated into a single deflate stream. Compression in zlib
+    releases GIL, therefore the threads use multiple cores.
+    """
+
+    def __init__(self, path: str, level: int = 6, threads: int = None,
+                 block_size: int = 1024 * 1024):
+        super().__init__()
+        self.path = path
+        self.aborted = False
+        self.level = level
+        self.block_size = block_size
+        if not threads:
+            threads = os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.crc = 0
+        self.size = 0
+        self.file = open(path, "wb")
+        self.file.write(struct.pack(
+            "<BBBBIBB", 0x1f, 0x8b, zlib.DEFLATED, 0, int(time.time()), 0, 255
+        ))
+
+    def writable(self) -> bool:
+        return True
+
+    @staticmethod
+    def deflate(data: bytes, level: int, last: bool) -> bytes:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        return compressor.compress(data) + compressor.flush(mode)
+
+    def submit(self, data: bytes, last: bool = False):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.pending.append(
+            self.executor.submit(self.deflate, data, self.level, last)
+        )
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def write(self, b) -> int:
+        if self.aborted:
+            return len(b)
+        self.buffer += b
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(b)
+
+    def abort(self):
+        """
+        Discards the data, that has not been written yet. The file
+        is closed without gzip trailer by a subsequent `close()`
+        """
+
+        self.aborted = True
+        self.buffer = bytearray()
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.aborted:
+                return
+            self.submit(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+            self.file.write(struct.pack(
+                "<II", self.crc & 0xffffffff, self.size & 0xffffffff
+            ))
+        finally:
+            self.executor.shutdown()
+            self.file.close()
+            super().close()
+
+
+class OutputFile:
+    """
+    Compressed file opened for writing. Behaves as the underlying
+    stream, but when used as a context manager, removes the file
+    if the `with` block raises an exception
+    """
+
+    def __init__(self, stream, path: str, raw: ParallelGzipWriter = None):
+        """
+        :param stream: Stream writing the file
+        :param path: Path to the file
+        :param raw: Parallel gzip writer under the stream, if any
+        """
+
+        self.stream = stream
+        self.path = path
+        self.raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __enter__(self):
+        self.stream.__enter__()
+        return self.stream
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            return self.stream.__exit__(exc_type, exc_val, exc_tb)
+        if self.raw is not None:
+            self.raw.abort()
+        try:
+            self.stream.close()
+        except Exception:
+            pass
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        return False
+
+
+def open_output(path: str, mode: str = "wt", threads: int = None,
+                level: int = None, encoding: str = None, codec: str = None):
+    """
+    Opens a file for writing, compressing the output according to
+    the file extension
+
+    :param path: Path to the file
+    :param mode: Either "wt" or "wb"
+    :param threads: Number of compression threads. For gzip,
+        one thread means using the standard gzip module
+    :param level: Compression level, the default depends on the format
+    :param encoding: Encoding for text mode
+    :param codec: Compression format, overrides the file extension
+    :return: File-like object
+    """
+
+    if codec is None:
+        codec = codec_for(path)
+    binary = 'b' in mode
+    if codec == GZIP:
+        if level is None:
+            level = 6
+        if threads == 1:
+            return OutputFile(
+                gzip.open(path, mode, compresslevel=level,
+                          encoding=encoding),
+                path
+            )
+        raw = ParallelGzipWriter(path, level=level, threads=threads)
+        stream = io.BufferedWriter(raw, buffer_size=raw.block_size)
+    elif codec == ZSTD:
+        import zstandard
+        cctx = zstandard.ZstdCompressor(
+            level=level if level is not None else 3,
+            threads=threads if threads else -1
+        )
+        return OutputFile(
+            zstandard.open(path, mode, cctx=cctx, encoding=encoding), path
+        )
+    elif codec == LZ4:
+        import lz4.frame
+        return OutputFile(
+            lz4.frame.open(
+                path, mode,
+                compression_level=level if level is not None else 0,
+                encoding=encoding
+            ),
+            path
+        )
+    else:
+        return open(path, mode, encoding=encoding)
+    if not binary:
+        stream = io.TextIOWrapper(stream, encoding=encoding)
+    return OutputFile(stream, path, raw)
+
+
+def open_input(path: str, mode: str = "rt", encoding: str = None):
+    """
+    Opens a file for reading, that has been written by open_output()
+    """
+
+    codec = codec_for(path)
+    if codec == ZSTD:
+        import zstandard
+        return zstandard.open(path, mode, encoding=encoding)
+    if codec == LZ4:
+        import lz4.frame
+        return lz4.frame.open(path, mode, encoding=encoding)
+    return fopen(path, mode)
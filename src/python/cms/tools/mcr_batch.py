@@ -0,0 +1,266 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Vectorized decoding of fixed width DAT files.
+
+Records are read in blocks from a memory mapped file. Every column
+of a block is viewed as a strided NumPy array over the mapped pages
+(no copying) and converted at once: numbers and dates are computed
+from their digits, strings are decoded in a single cast.
+Values that cannot be handled by the vectorized code are converted
+one by one with the same functions as used by
+:class:`cms.tools.mcr_file.RecordDecoder`, hence the output is the same
+as produced by record-by-record decoding.
+"""
+
+from typing import List, Iterator, Tuple, Optional
+
+import numpy
+
+from cms.tools.mcr_dat import DatReader
+from cms.tools.mcr_file import RecordDecoder, to_int
+
+
+POW10 = numpy.array([10 ** i for i in range(19)], dtype=numpy.int64)
+
+
+class BatchDecoder:
+    """
+    Decodes blocks of fixed width records into columns
+    """
+
+    def __init__(self, columns, record_len: int, stride: int = None):
+        """
+        :param columns: Column descriptors, either
+            :class:`cms.tools.mcr_file.Column` or columns of FWFMeta
+            returned by `MedicareFTS.to_fwf_meta`
+        :param record_len: Length of a record, excluding line terminator
+        :param stride: Length of a record including line terminator
+        """
+
+        self.columns = list(columns)
+        self.record_len = record_len
+        self.stride = stride if stride else record_len
+        self.decoder = RecordDecoder(self.columns)
+        self.converters = [self.converter(c) for c in self.columns]
+
+    def converter(self, column):
+        if column.type == "NUM" and not column.d:
+            return self.to_int
+        if column.type == "DATE" and column.end - column.start == 8:
+            return self.to_date
+        if column.type == "DATE":
+            return self.to_date_scalar
+        return self.to_str
+
+    def u8(self, buffer, n: int, start: int, end: int) -> numpy.ndarray:
+        return numpy.ndarray(
+            shape=(n, end - start),
+            dtype=numpy.uint8,
+            buffer=buffer,
+            offset=start,
+            strides=(self.stride, 1)
+        )
+
+    def text(self, buffer, i: int, column) -> str:
+        base = i * self.stride
+        return bytes(buffer[base + column.start:base + column.end])\
+            .decode("utf-8")
+
+    def record(self, buffer, i: int) -> bytes:
+        base = i * self.stride
+        return bytes(buffer[base:base + self.record_len])
+
+    def aligned(self, buffer, n: int) -> bool:
+        """
+        Checks that every record in the buffer is followed by
+        a line terminator, i.e. that the records can be
+        addressed with a constant stride
+        """
+
+        if self.stride == self.record_len:
+            # Records are not separated by line terminators, hence
+            # any terminator means that the records are misaligned
+            records = self.u8(buffer, n, 0, self.record_len)
+            return not ((records == 10) | (records == 13)).any()
+        terminators = self.u8(buffer, n, self.record_len, self.stride)
+        return bool(((terminators == 10) | (terminators == 13)).all())
+
+    def to_str(self, buffer, n: int, column) -> List[str]:
+        w = column.end - column.start
+        if (self.u8(buffer, n, column.start, column.end) == 0).any():
+            # NumPy would strip trailing zero bytes
+            return [self.text(buffer, i, column) for i in range(n)]
+        values = numpy.ndarray(
+            shape=(n,),
+            dtype="S{:d}".format(w),
+            buffer=buffer,
+            offset=column.start,
+            strides=(self.stride,)
+        )
+        try:
+            return values.astype("U{:d}".format(w)).tolist()
+        except UnicodeError:
+            return [self.text(buffer, i, column) for i in range(n)]
+
+    def to_int(self, buffer, n: int, column) -> list:
+        v = self.u8(buffer, n, column.start, column.end)
+        w = v.shape[1]
+        digit = (v >= 48) & (v <= 57)
+        if w > 18 or not (digit | (v == 32)).all():
+            return [to_int(self.text(buffer, i, column)) for i in range(n)]
+        ndigits = digit.sum(axis=1)
+        first = numpy.argmax(digit, axis=1)
+        last = w - 1 - numpy.argmax(digit[:, ::-1], axis=1)
+        has_digits = ndigits > 0
+        if ((last - first + 1 != ndigits) & has_digits).any():
+            # spaces between digits, int() will raise an error
+            return [to_int(self.text(buffer, i, column)) for i in range(n)]
+        exps = numpy.clip(last[:, None] - numpy.arange(w), 0, 18)
+        digits = numpy.where(digit, v.astype(numpy.int64) - 48, 0)
+        result = (digits * POW10[exps]).sum(axis=1).tolist()
+        for i in numpy.flatnonzero(~has_digits):
+            result[i] = None
+        return result
+
+    def to_date(self, buffer, n: int, column) -> list:
+        v = self.u8(buffer, n, column.start, column.end)
+        blank = (v == 32).all(axis=1)
+        d = v.astype(numpy.int64) - 48
+        y = d[:, 0] * 1000 + d[:, 1] * 100 + d[:, 2] * 10 + d[:, 3]
+        m = d[:, 4] * 10 + d[:, 5]
+        dd = d[:, 6] * 10 + d[:, 7]
+        ok = ((v >= 48) & (v <= 57)).all(axis=1)
+        ok &= (y > 0) & (m >= 1) & (m <= 12) & (dd >= 1) & (dd <= 31)
+        months = numpy.where(ok, (y - 1970) * 12 + m - 1, 0)\
+            .astype("datetime64[M]")
+        days = months.astype("datetime64[D]") \
+            + numpy.where(ok, dd - 1, 0).astype("timedelta64[D]")
+        # Days overflowing into the next month, e.g. Feb 30
+        ok &= days.astype("datetime64[M]") == months
+        result = days.astype("datetime64[s]").tolist()
+        for i in numpy.flatnonzero(~ok):
+            if blank[i]:
+                result[i] = None
+            else:
+                result[i] = self.decoder.to_date(
+                    column.name, self.text(buffer, i, column)
+                )
+        return result
+
+    def to_date_scalar(self, buffer, n: int, column) -> list:
+        return [
+            self.decoder.to_date(column.name, self.text(buffer, i, column))
+            for i in range(n)
+        ]
+
+    def decode_columns(self, buffer, n: int) -> List[list]:
+        """
+        Decodes the first n records in the buffer
+
+        :return: list of columns, each column is a list of values
+        :raises: Exception if any of the values cannot be converted.
+            In this case the caller should decode the records one
+            by one to locate the bad ones
+        """
+
+        return [
+            conv(buffer, n, column)
+            for conv, column in zip(self.converters, self.columns)
+        ]
+
+    def decode(self, buffer, n: int) -> List[tuple]:
+        """
+        Decodes the first n records in the buffer
+
+        :return: list of records
+        """
+
+        return list(zip(*self.decode_columns(buffer, n)))
+
+    def read(self, path: str, batch_size: int, offset: int = 0,
+             end: int = None) -> Iterator[Tuple[int, memoryview, int]]:
+        """
+        Reads a memory mapped file in blocks of `batch_size` records,
+        starting at `offset` and stopping at `end`, if specified
+
+        Stops at the end of file or at the first block where line
+        terminators are not where expected. The caller should process
+        the rest of the file, starting with the offset that follows
+        the last yielded block, record by record.
+
+        :return: Iterator over tuples (offset, buffer, number of records)
+        """
+
+        length = batch_size * self.stride
+        with DatReader(path, self.record_len) as reader:
+            limit = reader.size if end is None else min(end, reader.size)
+            while offset < limit:
+                buffer = reader.block(offset, min(length, limit - offset))
+                size = len(buffer)
+                full = size // self.stride
+                n = full
+                if size < length and size - n * self.stride \
+                        >= self.record_len:
+                    # last record is not followed by a newline
+                    n += 1
+                if n < 1 or not self.aligned(buffer, full):
+                    break
+                yield offset, buffer, n
+                buffer = None
+                offset += min(n * self.stride, size)
+                if size < length:
+                    break
+
+    def records(self, path: str, batch_size: int) -> Iterator[Optional[tuple]]:
+        """
+        Yields decoded records of a file. Records that
+        cannot be decoded are logged and skipped.
+        """
+
+        offset = 0
+        dates = self.decoder.dates
+        for offset, buffer, n in self.read(path, batch_size):
+            snapshot = dates.snapshot()
+            try:
+                records = self.decode(buffer, n)
+            except Exception:
+                records = None
+            if records is not None:
+                yield from records
+            else:
+                # the batch is decoded again record by record
+                dates.restore(snapshot)
+                for i in range(n):
+                    try:
+                        yield self.decoder.decode(self.record(buffer, i), i)
+                    except Exception as x:
+                        print("{}: bad record at {:,d}: {}".format(
+                            path, offset + i * self.stride, str(x)
+                        ))
+            offset += n * self.stride
+        with DatReader(path, self.record_len, offset) as reader:
+            for record in reader:
+                try:
+                    yield self.decoder.decode(record, reader.current)
+                except Exception as x:
+                    print("{}: bad record at {:,d}: {}".format(
+                        path, reader.current, str(x)
+                    ))
@@ -0,0 +1,134 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Benchmark for decoding Medicare DAT records.
+
+Reads a sample of records from the DAT files described by an FTS file
+and decodes them both with the original column-by-column algorithm
+and with the compiled decoder used by MedicareFile. Verifies that
+both produce the same output and prints records per second
+for each of them.
+"""
+
+import os
+import time
+from argparse import ArgumentParser
+from typing import List
+
+from cms.tools.mcr_dat import DatReader
+from cms.tools.mcr_file import MedicareFile, MedparParseException, \
+    date_parser, log
+
+
+def reference_read_record(mfile: MedicareFile, data, ln):
+    """
+    Original implementation of MedicareFile.read_record, kept
+    as a baseline for the benchmark
+    """
+
+    exception_count = 0
+    pieces = {}
+    for name in mfile.columns:
+        column = mfile.columns[name]
+        pieces[name] = data[column.start:column.end]
+    record = []
+    for name in mfile.columns:
+        column = mfile.columns[name]
+        s = pieces[name].decode("utf-8")
+        try:
+            if column.type == "NUM" and not column.d:
+                val = s.strip()
+                if val:
+                    record.append(int(val))
+                else:
+                    record.append(None)
+            elif column.type == "DATE":
+                if s.strip():
+                    record.append(date_parser.parse(s))
+                else:
+                    record.append(None)
+            else:
+                record.append(s)
+        except Exception as x:
+            log("{:d}: {}[{:d}]: - {}".format(
+                ln, column.name, column.ord, str(x))
+            )
+            record.append(s)
+            exception_count += 1
+            if exception_count > 3:
+                log(data)
+                raise MedparParseException("Too meany exceptions", column.start)
+    return record
+
+
+def sample(mfile: MedicareFile, n: int) -> List[bytes]:
+    records = []
+    for dat in mfile.dat:
+        with DatReader(dat, mfile.block_size) as reader:
+            for record in reader:
+                if len(records) >= n:
+                    break
+                records.append(bytes(record))
+    return records
+
+
+def measure(name: str, decode, records: List[bytes]) -> list:
+    t0 = time.perf_counter()
+    result = [decode(records[i], i) for i in range(len(records))]
+    elapsed = time.perf_counter() - t0
+    print("{}: {:,d} records in {:.3f} sec, {:,.0f} records/sec".format(
+        name, len(records), elapsed, len(records) / elapsed
+    ))
+    return result
+
+
+def benchmark(fts_path: str, n: int):
+    f, _ = os.path.splitext(fts_path)
+    dir_path, name = os.path.split(f)
+    mfile = MedicareFile(dir_path, name)
+    records = sample(mfile, n)
+    if not records:
+        raise ValueError("No records found for " + fts_path)
+    before = measure(
+        "Reference",
+        lambda data, ln: reference_read_record(mfile, data, ln),
+        records
+    )
+    after = measure("Compiled", mfile.read_record, records)
+    mismatches = sum(1 for i in range(len(records)) if before[i] != after[i])
+    if mismatches:
+        raise AssertionError(
+            "Decoders disagree on {:,d} records".format(mismatches)
+        )
+    print("Outputs are identical")
+
+
+def args():
+    parser = ArgumentParser ("Benchmark for decoding Medicare DAT records")
+    parser.add_argument(help="Path to an FTS file", dest="fts")
+    parser.add_argument("--records", "-n", type=int, default=100000,
+                        help="Number of records to decode")
+    arguments = parser.parse_args()
+    return arguments
+
+
+if __name__ == '__main__':
+    my_args = args()
+    benchmark(my_args.fts, my_args.records)
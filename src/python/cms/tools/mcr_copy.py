@@ -0,0 +1,708 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Streams Medicare DAT files directly into PostgreSQL.
+
+DAT files are split into shards of records. Every shard is decoded
+in a separate process and sent to the database over its own
+connection with `COPY ... FROM STDIN`, in large buffered chunks.
+No intermediate CSV files are created.
+
+Records can be sent either in text or in binary COPY format. With
+binary format, numbers and dates are sent in PostgreSQL internal
+representation, hence the server does not have to parse them again.
+
+Records with values that cannot be represented in the column type
+(e.g. invalid dates kept as strings by the decoder) are logged and
+skipped in both formats, so that a single bad value does not make
+the server reject the whole shard.
+
+Every shard is committed in the same transaction as a row in
+a progress table (`dat_copy_progress` in the schema of the target
+table). When the loader is run again, shards that have been committed
+are skipped. The progress of a table is cleared if the table is empty,
+e.g. when it has been recreated. Shard boundaries depend on the shard
+size, therefore a table can only be resumed with the same shard size
+as the one used by the previous run.
+
+The table must already exist, e.g. created by
+:class:`cms.tools.mcr_fts2db.MedicareLoader` or by the `create`
+step of the pipeline.
+"""
+
+import concurrent.futures
+import datetime
+import glob
+import os
+import struct
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import List, Iterator, Optional
+
+from nsaph import ORIGINAL_FILE_COLUMN
+from nsaph.db import Connection
+from nsaph.pg_keywords import PG_NUMERIC_TYPE, PG_INT_TYPE, PG_DATE_TYPE
+
+from cms.fts2yaml import MedicareFTS, FTSColumn, AliasColumn, mcr_type
+from cms.tools.mcr_dat import DatReader, shard_ranges
+from cms.tools.mcr_file import RecordDecoder, MedparParseException, log
+
+
+DEFAULT_SHARD_SIZE = 1000000
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+TEXT = "text"
+BINARY = "binary"
+COPY_FORMATS = [TEXT, BINARY]
+INT4_MIN = -2 ** 31
+INT4_MAX = 2 ** 31 - 1
+PROGRESS_TABLE = "dat_copy_progress"
+
+CREATE_PROGRESS = """
+CREATE TABLE IF NOT EXISTS {progress} (
+    table_name VARCHAR(256) NOT NULL,
+    dat VARCHAR(256) NOT NULL,
+    start_offset BIGINT NOT NULL,
+    end_offset BIGINT NOT NULL,
+    dat_size BIGINT NOT NULL,
+    shard_size INT NOT NULL,
+    records INT NOT NULL,
+    skipped INT NOT NULL,
+    loaded TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, dat, start_offset)
+)
+"""
+
+RECORD_PROGRESS = """
+INSERT INTO {progress}
+    (table_name, dat, start_offset, end_offset, dat_size, shard_size,
+        records, skipped)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+SELECT_PROGRESS = """
+SELECT dat, start_offset, end_offset, dat_size, shard_size
+FROM {progress}
+WHERE table_name = %s
+"""
+
+CLEAR_PROGRESS = """
+DELETE FROM {progress} WHERE table_name = %s
+"""
+
+
+def progress_table(table: str) -> str:
+    """
+    Name of the progress table for a given target table
+    """
+
+    if '.' in table:
+        return "{}.{}".format(table.split('.', 1)[0], PROGRESS_TABLE)
+    return PROGRESS_TABLE
+
+
+class TextCopyEncoder:
+    """
+    Encodes records into PostgreSQL text COPY format
+    """
+
+    NULL = b"\\N"
+    SPECIAL = str.maketrans({
+        '\\': "\\\\",
+        '\t': "\\t",
+        '\n': "\\n",
+        '\r': "\\r"
+    })
+
+    def __init__(self, columns: List[FTSColumn]):
+        """
+        :param columns: Columns of the table in the order of COPY
+        """
+
+        self.columns = columns
+        self.converters = [self.converter(c) for c in columns]
+
+    def converter(self, column: FTSColumn):
+        t = column.to_sql_type().upper()
+        if t == PG_INT_TYPE:
+            return self.integer
+        if t.startswith(PG_NUMERIC_TYPE):
+            return self.number
+        if t == PG_DATE_TYPE:
+            return self.date
+        return self.string
+
+    @property
+    def options(self) -> str:
+        return ""
+
+    def header(self) -> bytes:
+        return b''
+
+    def trailer(self) -> bytes:
+        return b''
+
+    def string(self, value) -> bytes:
+        s = str(value)
+        if '\\' in s or '\t' in s or '\n' in s or '\r' in s:
+            s = s.translate(self.SPECIAL)
+        return s.encode("utf-8")
+
+    def integer(self, value) -> bytes:
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                return self.NULL
+            value = int(value)
+        if not INT4_MIN <= value <= INT4_MAX:
+            raise ValueError("Integer out of range: " + str(value))
+        return str(value).encode("ascii")
+
+    def number(self, value) -> bytes:
+        if isinstance(value, str):
+            # numbers with decimal point are not converted by decoder
+            value = value.strip()
+            if not value:
+                return self.NULL
+        try:
+            d = Decimal(value)
+        except InvalidOperation:
+            raise ValueError("Invalid number: " + str(value))
+        if not d.is_finite():
+            raise ValueError("Invalid number: " + str(value))
+        return str(d).encode("ascii")
+
+    def date(self, value) -> bytes:
+        if isinstance(value, datetime.date):
+            return value.strftime("%Y-%m-%d").encode("ascii")
+        if isinstance(value, str) and not value.strip():
+            return self.NULL
+        raise ValueError("Invalid date: " + str(value))
+
+    def encode(self, record) -> bytes:
+        return b'\t'.join([
+            self.NULL if value is None else conv(value)
+            for conv, value in zip(self.converters, record)
+        ]) + b'\n'
+
+
+class BinaryCopyEncoder:
+    """
+    Encodes records into PostgreSQL binary COPY format.
+
+    The binary representation of every column is selected by
+    the SQL type of the column, as returned by `FTSColumn.to_sql_type`:
+    INT is sent as int4, NUMERIC(p,s) as base 10000 digits,
+    VARCHAR(n) as UTF-8 text and DATE as number of days
+    since 2000-01-01.
+    """
+
+    SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+    NULL = struct.pack(">i", -1)
+    INT4 = struct.Struct(">i")
+    INT2 = struct.Struct(">h")
+    NUMERIC_POS = 0x0000
+    NUMERIC_NEG = 0x4000
+    PG_EPOCH = datetime.date(2000, 1, 1).toordinal()
+
+    def __init__(self, columns: List[FTSColumn]):
+        """
+        :param columns: Columns of the table in the order of COPY
+        """
+
+        self.columns = columns
+        self.converters = [self.converter(c) for c in columns]
+        self.tuple_header = self.INT2.pack(len(columns))
+
+    def converter(self, column: FTSColumn):
+        t = column.to_sql_type().upper()
+        if t == PG_INT_TYPE:
+            return self.int4
+        if t.startswith(PG_NUMERIC_TYPE):
+            return self.numeric
+        if t == PG_DATE_TYPE:
+            return self.date
+        return self.string
+
+    @property
+    def options(self) -> str:
+        return "WITH (FORMAT binary)"
+
+    def header(self) -> bytes:
+        return self.SIGNATURE + self.INT4.pack(0) + self.INT4.pack(0)
+
+    def trailer(self) -> bytes:
+        return self.INT2.pack(-1)
+
+    @staticmethod
+    def string(value) -> bytes:
+        return str(value).encode("utf-8")
+
+    def int4(self, value) -> Optional[bytes]:
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                return None
+            value = int(value)
+        return self.INT4.pack(value)
+
+    def numeric(self, value) -> Optional[bytes]:
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                return None
+        try:
+            sign, digits, exp = Decimal(value).as_tuple()
+        except InvalidOperation:
+            raise ValueError("Invalid number: " + str(value))
+        if not isinstance(exp, int):
+            raise ValueError("Invalid number: " + str(value))
+        dscale = max(0, -exp)
+        digits = "".join(str(d) for d in digits)
+        if exp > 0:
+            digits += "0" * exp
+            exp = 0
+        n = len(digits) + exp
+        if n < 0:
+            digits = "0" * -n + digits
+            n = 0
+        int_part = digits[:n]
+        frac_part = digits[n:]
+        int_part = "0" * (-len(int_part) % 4) + int_part
+        frac_part = frac_part + "0" * (-len(frac_part) % 4)
+        groups = [
+            int(int_part[i:i + 4]) for i in range(0, len(int_part), 4)
+        ] + [
+            int(frac_part[i:i + 4]) for i in range(0, len(frac_part), 4)
+        ]
+        weight = len(int_part) // 4 - 1
+        while groups and groups[0] == 0:
+            groups.pop(0)
+            weight -= 1
+        while groups and groups[-1] == 0:
+            groups.pop()
+        if not groups:
+            weight = 0
+        return struct.pack(
+            ">hhhh{:d}h".format(len(groups)),
+            len(groups),
+            weight,
+            self.NUMERIC_NEG if sign else self.NUMERIC_POS,
+            dscale,
+            *groups
+        )
+
+    def date(self, value) -> Optional[bytes]:
+        if isinstance(value, datetime.date):
+            return self.INT4.pack(value.toordinal() - self.PG_EPOCH)
+        if isinstance(value, str) and not value.strip():
+            return None
+        raise ValueError("Invalid date: " + str(value))
+
+    def encode(self, record) -> bytes:
+        fields = [self.tuple_header]
+        for conv, value in zip(self.converters, record):
+            data = None if value is None else conv(value)
+            if data is None:
+                fields.append(self.NULL)
+            else:
+                fields.append(self.INT4.pack(len(data)))
+                fields.append(data)
+        return b''.join(fields)
+
+
+class CopyStream:
+    """
+    File-like object, that encodes records in COPY format when
+    the database driver reads from it
+    """
+
+    def __init__(self, encoder, records: Iterator):
+        self.encoder = encoder
+        self.records = records
+        self.buffer = bytearray(encoder.header())
+        self.done = False
+        self.count = 0
+        self.skipped = 0
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            try:
+                record = next(self.records)
+            except StopIteration:
+                self.done = True
+                self.buffer += self.encoder.trailer()
+                break
+            try:
+                self.buffer += self.encoder.encode(record)
+            except (ValueError, struct.error) as x:
+                log("Record is not copied: {}: {}".format(str(x), record))
+                self.skipped += 1
+                continue
+            self.count += 1
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.size += size
+        return chunk
+
+
+class CopyTask:
+    """
+    A shard of a DAT file to be copied into the database
+    """
+
+    def __init__(self, fts_path: str, dat: str, start: int, end: int,
+                 table: str, db: str, connection: str,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 copy_format: str = TEXT,
+                 shard_size: int = DEFAULT_SHARD_SIZE):
+        self.fts_path = fts_path
+        self.dat = dat
+        self.start = start
+        self.end = end
+        self.table = table
+        self.db = db
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.copy_format = copy_format
+        self.shard_size = shard_size
+
+    def __str__(self) -> str:
+        return "{}[{:,d}:{:,d}]".format(
+            os.path.basename(self.dat), self.start, self.end
+        )
+
+
+class CopyStats:
+    """
+    Throughput counters for a shard or a whole file
+    """
+
+    def __init__(self, records: int = 0, dat_bytes: int = 0,
+                 sent_bytes: int = 0, seconds: float = 0,
+                 skipped: int = 0):
+        self.records = records
+        self.skipped = skipped
+        self.dat_bytes = dat_bytes
+        self.sent_bytes = sent_bytes
+        self.seconds = seconds
+
+    def add(self, other: "CopyStats"):
+        self.records += other.records
+        self.skipped += other.skipped
+        self.dat_bytes += other.dat_bytes
+        self.sent_bytes += other.sent_bytes
+
+    def __str__(self) -> str:
+        seconds = max(self.seconds, 1e-6)
+        return "{:,d} records ({:,d} skipped), {:,.1f} MB read, {:,.1f} MB sent " \
+               "in {:.1f} sec: {:,.0f} records/sec, {:,.1f} MB/sec".format(
+                    self.records,
+                    self.skipped,
+                    self.dat_bytes / 1e6,
+                    self.sent_bytes / 1e6,
+                    self.seconds,
+                    self.records / seconds,
+                    self.dat_bytes / 1e6 / seconds
+                )
+
+
+def copy_columns(fts: MedicareFTS) -> List[FTSColumn]:
+    """
+    Columns of a table, that are filled by COPY: columns read from
+    DAT file and the name of the original file. Record numbers and
+    aliases are generated by the database.
+    """
+
+    return [
+        c for c in fts.columns
+        if (c.is_input and not isinstance(c, AliasColumn))
+           or c.column == ORIGINAL_FILE_COLUMN
+    ]
+
+
+def shard_records(fts: MedicareFTS, dat: str, start: int, end: int) \
+        -> Iterator[list]:
+    """
+    Decodes records of a shard and appends the name of the file to
+    every record. Records that cannot be parsed are logged and skipped.
+    """
+
+    meta = fts.to_fwf_meta(dat)
+    names = set(c.column for c in copy_columns(fts))
+    decoder = RecordDecoder([c for c in meta.columns if c.name in names])
+    file_name = os.path.basename(dat)
+    with DatReader(dat, meta.record_len, start, end) as reader:
+        for data in reader:
+            try:
+                record = decoder.decode(data, reader.current)
+            except MedparParseException as x:
+                log("{}: {:,d}: {}".format(file_name, reader.current, str(x)))
+                reader.resync(x.pos)
+                continue
+            record.append(file_name)
+            yield record
+
+
+def encoder_for(columns: List[FTSColumn], copy_format: str = TEXT):
+    """
+    Returns an encoder for a given COPY format
+    """
+
+    if copy_format == BINARY:
+        return BinaryCopyEncoder(columns)
+    if copy_format == TEXT:
+        return TextCopyEncoder(columns)
+    raise ValueError("Unsupported COPY format: " + str(copy_format))
+
+
+def copy_shard(task: CopyTask) -> CopyStats:
+    """
+    Copies a shard of a DAT file into the database over
+    a dedicated connection. Runs in a worker process.
+    """
+
+    t0 = time.perf_counter()
+    fname = os.path.basename(task.fts_path)
+    fts = MedicareFTS(mcr_type(fname)).init(task.fts_path)
+    columns = copy_columns(fts)
+    encoder = encoder_for(columns, task.copy_format)
+    stream = CopyStream(
+        encoder, shard_records(fts, task.dat, task.start, task.end)
+    )
+    sql = "COPY {} ({}) FROM STDIN {}".format(
+        task.table,
+        ", ".join(c.column for c in columns),
+        encoder.options
+    )
+    with Connection(task.db, task.connection, silent=True) as connection:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, stream, size=task.chunk_size)
+            # committed together with the data
+            cursor.execute(
+                RECORD_PROGRESS.format(progress=progress_table(task.table)),
+                (task.table, os.path.basename(task.dat), task.start,
+                 task.end, os.path.getsize(task.dat), task.shard_size,
+                 stream.count, stream.skipped)
+            )
+        connection.commit()
+    return CopyStats(
+        records=stream.count,
+        skipped=stream.skipped,
+        dat_bytes=task.end - task.start,
+        sent_bytes=stream.size,
+        seconds=time.perf_counter() - t0
+    )
+
+
+class DatCopyLoader:
+    """
+    Loads DAT files described by an FTS file into a table, streaming
+    decoded records through parallel COPY connections
+    """
+
+    def __init__(self, fts_path: str, db: str, connection: str,
+                 table: str = None, schema: str = "cms",
+                 workers: int = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 copy_format: str = TEXT, resume: bool = True):
+        """
+        :param fts_path: Path to FTS file
+        :param db: Path to a database connection parameters file
+        :param connection: Section in the database connection
+            parameters file
+        :param table: Fully qualified name of the table, by default
+            is derived from the FTS file name and its directory
+        :param schema: Schema used when the table name is derived
+        :param workers: Number of parallel processes and connections
+        :param shard_size: Number of records copied by a single
+            COPY command
+        :param chunk_size: Number of bytes sent to the server at once
+        :param copy_format: Either "text" or "binary"
+        :param resume: Skip shards that have been committed by
+            a previous run, otherwise the progress is cleared
+        """
+
+        self.fts_path = fts_path
+        self.resume = resume
+        self.db = db
+        self.connection = connection
+        self.workers = workers
+        self.shard_size = shard_size
+        self.chunk_size = chunk_size
+        self.copy_format = copy_format
+        f, _ = os.path.splitext(fts_path)
+        self.fts = MedicareFTS(mcr_type(os.path.basename(f)))\
+            .init(fts_path)
+        if table is None:
+            table = "{}.{}".format(schema, self.fts.table_name)
+        self.table = table
+        self.dat_files = sorted(glob.glob("{}*.dat".format(f)))
+
+    def tasks(self) -> List[CopyTask]:
+        tasks = []
+        for dat in self.dat_files:
+            record_len = self.fts.to_fwf_meta(dat).record_len
+            for start, end in shard_ranges(dat, record_len, self.shard_size):
+                tasks.append(CopyTask(
+                    self.fts_path, dat, start, end, self.table,
+                    self.db, self.connection, self.chunk_size,
+                    self.copy_format, self.shard_size
+                ))
+        return tasks
+
+    def committed(self) -> set:
+        """
+        Prepares the progress table and returns shards committed
+        by previous runs
+
+        :return: Set of tuples (dat file name, start, end)
+        :raises ValueError: if the shards have been committed with
+            a different shard size, their boundaries do not match
+            the current shards
+        """
+
+        progress = progress_table(self.table)
+        with Connection(self.db, self.connection, silent=True) as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(CREATE_PROGRESS.format(progress=progress))
+                cursor.execute(
+                    "SELECT EXISTS (SELECT 1 FROM {})".format(self.table)
+                )
+                not_empty = cursor.fetchone()[0]
+                if not self.resume or not not_empty:
+                    cursor.execute(CLEAR_PROGRESS.format(progress=progress),
+                                   (self.table,))
+                    done = set()
+                else:
+                    cursor.execute(SELECT_PROGRESS.format(progress=progress),
+                                   (self.table,))
+                    sizes = {
+                        os.path.basename(dat): os.path.getsize(dat)
+                        for dat in self.dat_files
+                    }
+                    rows = cursor.fetchall()
+                    other = sorted({
+                        n for _, _, _, _, n in rows if n != self.shard_size
+                    })
+                    if other:
+                        raise ValueError(
+                            "{} has been partially loaded with shard size "
+                            "{}, while the shard size is {:,d}. Resume "
+                            "with the same shard size or restart the load"
+                            .format(self.table,
+                                    ", ".join(str(n) for n in other),
+                                    self.shard_size)
+                        )
+                    done = {
+                        (dat, start, end)
+                        for dat, start, end, size, _ in rows
+                        if sizes.get(dat) == size
+                    }
+            connection.commit()
+        return done
+
+    def run(self) -> Optional[CopyStats]:
+        tasks = self.tasks()
+        if not tasks:
+            print("No data found for " + self.fts_path)
+            return None
+        done = self.committed()
+        if done:
+            tasks = [
+                t for t in tasks
+                if (os.path.basename(t.dat), t.start, t.end) not in done
+            ]
+            print("{}: {:,d} shards have been already loaded".format(
+                self.table, len(done)
+            ))
+            if not tasks:
+                print("{}: SUCCESS: nothing to load".format(self.table))
+                return CopyStats()
+        t0 = time.perf_counter()
+        total = CopyStats()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(copy_shard, task): task for task in tasks
+            }
+            for future in concurrent.futures.as_completed(futures):
+                stats = future.result()
+                total.add(stats)
+                total.seconds = time.perf_counter() - t0
+                print("{}: {}".format(futures[future], stats))
+                print("{} [{:,d}/{:,d}]: {}".format(
+                    self.table, len([f for f in futures if f.done()]),
+                    len(tasks), total
+                ))
+        print("{}: SUCCESS: {}".format(self.table, total))
+        return total
+
+
+def args():
+    parser = ArgumentParser ("Streams Medicare DAT files into PostgreSQL")
+    parser.add_argument(help="Path to FTS files", dest="fts", nargs='+')
+    parser.add_argument("--db",
+                        help="Path to a database connection parameters file",
+                        default="database.ini",
+                        required=False)
+    parser.add_argument("--connection",
+                        help="Section in the database connection parameters file",
+                        default="nsaph2",
+                        required=False)
+    parser.add_argument("--table",
+                        help="Fully qualified table name, by default derived "
+                             + "from the FTS file name",
+                        required=False)
+    parser.add_argument("--workers", "-w", type=int,
+                        help="Number of parallel COPY connections")
+    parser.add_argument("--shard-size", type=int,
+                        default=DEFAULT_SHARD_SIZE,
+                        help="Number of records copied by a single COPY")
+    parser.add_argument("--chunk-size", type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help="Number of bytes sent to the server at once")
+    parser.add_argument("--format", choices=COPY_FORMATS, default=BINARY,
+                        help="COPY format")
+    parser.add_argument("--restart", action='store_true',
+                        help="Load all shards again, ignoring shards "
+                             "committed by a previous run")
+    arguments = parser.parse_args()
+    return arguments
+
+
+if __name__ == '__main__':
+    my_args = args()
+    for fts_path in my_args.fts:
+        DatCopyLoader(
+            fts_path,
+            my_args.db,
+            my_args.connection,
+            table=my_args.table,
+            workers=my_args.workers,
+            shard_size=my_args.shard_size,
+            chunk_size=my_args.chunk_size,
+            copy_format=my_args.format,
+            resume=not my_args.restart
+        ).run()
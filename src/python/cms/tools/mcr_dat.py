@@ -0,0 +1,228 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Memory mapped access to fixed width DAT files.
+
+Records are returned as memoryview slices of the mapped file,
+hence reading a record neither copies the data nor allocates
+a new bytes object.
+"""
+
+import mmap
+import os
+from typing import List, Tuple
+
+
+NEWLINE_BYTES = b'\r\n'
+
+
+def record_stride(path: str, record_len: int) -> int:
+    """
+    Detects the length of a record, including its line terminator,
+    by looking at the first record of a file
+
+    :param path: path to DAT file
+    :param record_len: record length, as defined by FTS
+    :return: the distance in bytes between the starts of two
+        consecutive records
+    """
+
+    with open(path, "rb") as f:
+        head = f.read(record_len + 2)
+    stride = record_len
+    while stride < len(head) and head[stride] in NEWLINE_BYTES:
+        stride += 1
+    return stride
+
+
+def shard_ranges(path: str, record_len: int, shard_size: int) \
+        -> List[Tuple[int, int]]:
+    """
+    Splits a DAT file into byte ranges, each containing about
+    `shard_size` records. Every range starts at a record boundary.
+
+    :param path: path to DAT file
+    :param record_len: record length, as defined by FTS
+    :param shard_size: number of records in a shard
+    :return: list of tuples (start offset, end offset)
+    """
+
+    stride = record_stride(path, record_len)
+    with DatReader(path, record_len) as reader:
+        size = reader.size
+        starts = [0]
+        while True:
+            offset = starts[-1] + shard_size * stride
+            if stride > record_len:
+                offset = reader.align(offset)
+            if offset >= size:
+                break
+            starts.append(offset)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+class DatReader:
+    """
+    Iterates over records of a memory mapped DAT file.
+
+    Records are `record_len` bytes long and are separated by
+    any number of line terminators (CR or LF).
+    """
+
+    def __init__(self, path: str, record_len: int, offset: int = 0,
+                 end: int = None, index=None):
+        """
+        :param path: Path to DAT file
+        :param record_len: Length of a record in bytes, excluding line
+            terminators
+        :param offset: Offset of the first record to read
+        :param end: If specified, no record starting at or
+            after this offset is read
+        :param index: Optional :class:`cms.tools.mcr_index.RecordIndex`
+            of the file, used to resynchronize after corrupted records
+        """
+
+        self.path = path
+        self.record_len = record_len
+        self.index = index
+        self.pos = offset
+        self.end = end
+        self.current = None
+        self.size = None
+        self.file = None
+        self.mm = None
+        self.view = None
+
+    def open(self):
+        self.file = open(self.path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size > 0:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                self.mm.madvise(mmap.MADV_SEQUENTIAL)
+            self.view = memoryview(self.mm)
+        else:
+            self.view = memoryview(b'')
+        if self.end is None or self.end > self.size:
+            self.end = self.size
+        return self
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # Some records are still referenced, the mapping
+                # will be closed when they are garbage collected
+                pass
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> memoryview:
+        start = self.pos
+        if start >= self.end or start + self.record_len > self.size:
+            raise StopIteration
+        self.current = start
+        self.pos = self.skip_newlines(start + self.record_len)
+        return self.view[start:start + self.record_len]
+
+    def skip_newlines(self, pos: int) -> int:
+        while pos < self.size and self.mm[pos] in NEWLINE_BYTES:
+            pos += 1
+        return pos
+
+    def block(self, offset: int, length: int) -> memoryview:
+        """
+        Returns a view of a contiguous part of the file
+        """
+
+        return self.view[offset:min(offset + length, self.size)]
+
+    def align(self, offset: int) -> int:
+        """
+        Finds the start of the first record that starts at or
+        after a given offset, i.e. the first byte after a sequence of
+        line terminators
+
+        :param offset: An arbitrary offset in the file
+        :return: offset of a record start or the size of the file
+        """
+
+        if offset <= 0:
+            return 0
+        if offset >= self.size:
+            return self.size
+        if self.mm[offset - 1] in NEWLINE_BYTES \
+                and self.mm[offset] not in NEWLINE_BYTES:
+            return offset
+        found = [
+            i for i in (self.mm.find(b, offset) for b in [b'\n', b'\r'])
+            if i >= 0
+        ]
+        if not found:
+            return self.size
+        return self.skip_newlines(min(found))
+
+    def resync(self, pos: int):
+        """
+        Recovers after a record that could not be parsed: the next
+        record is read after the first line terminator found in
+        the current record after a given position.
+
+        If the terminator is not found, the next record starts with
+        the last byte of the current record, the same way as
+        MedicareFile.export always did.
+
+        :param pos: Position within the current record
+        """
+
+        start = self.current + pos
+        end = self.current + self.record_len
+        if self.index is not None and start < end:
+            nxt = self.index.next_start(start)
+            if nxt is not None:
+                if nxt - 1 < end or self.mm[end - 1] in NEWLINE_BYTES:
+                    # a terminator is found within the current record
+                    self.pos = nxt
+                else:
+                    self.pos = self.skip_newlines(end - 1)
+                return
+        found = [
+            i for i in (self.mm.find(b, start, end) for b in [b'\n', b'\r'])
+            if i >= 0
+        ]
+        if found:
+            self.pos = self.skip_newlines(min(found))
+        elif start < end:
+            self.pos = self.skip_newlines(end - 1)
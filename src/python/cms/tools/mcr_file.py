@@ -18,14 +18,22 @@
 
 import datetime
 import glob
-import gzip
 import os
 import shutil
 import traceback
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+from functools import partial
+from typing import List, Tuple, Optional, Dict, Iterable, Iterator
 from dateutil import parser as date_parser
 import csv
 
+from cms.tools.compression import open_output, open_input, GZIP
+from cms.tools.mcr_dat import DatReader, record_stride, shard_ranges
+from cms.tools.mcr_manifest import ExportManifest
+
+
+DEFAULT_CHECKPOINT = 1000000
+
 
 def log(s):
     with open("run.log", "at") as w:
@@ -97,9 +105,207 @@ class Column:
         return "{}: [{}]".format(super().__str__(), self.name)
 
 
+def to_int(s: str):
+    val = s.strip()
+    if val:
+        return int(val)
+    return None
+
+
+class DateParser:
+    """
+    Parser for dates in the fixed formats used in CMS files:
+    YYYYMMDD, YYYY-MM-DD and YYYY/MM/DD.
+
+    Recently parsed values are cached, as the number of distinct
+    dates in a file is small. Any other string is passed to dateutil.
+    The number of values that required dateutil and the number of
+    values that could not be parsed at all are counted per column.
+    Every value is counted, including the ones found in the cache.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self.cache_size = cache_size
+        self.cache = dict()
+        self.fallbacks = Counter()
+        self.failures = Counter()
+
+    @staticmethod
+    def parse_fixed(s: str) -> Optional[datetime.datetime]:
+        t = s.strip()
+        if len(t) == 8 and t.isascii() and t.isdigit():
+            y, m, d = t[:4], t[4:6], t[6:]
+        elif len(t) == 10 and t[4] in "-/" and t[7] == t[4]:
+            y, m, d = t[:4], t[5:7], t[8:]
+            if not (y + m + d).isascii() or not (y + m + d).isdigit():
+                return None
+        else:
+            return None
+        try:
+            return datetime.datetime(int(y), int(m), int(d))
+        except ValueError:
+            return None
+
+    def parse(self, s: str, column: str = None) -> datetime.datetime:
+        try:
+            value, fallback, error = self.cache[s]
+        except KeyError:
+            value, fallback, error = self.parse_new(s)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[s] = (value, fallback, error)
+        if fallback:
+            self.fallbacks[column] += 1
+        if error is not None:
+            self.failures[column] += 1
+            raise ValueError(error)
+        return value
+
+    def parse_new(self, s: str) \
+            -> Tuple[Optional[datetime.datetime], bool, Optional[str]]:
+        """
+        Parses a string, that is not in the cache
+
+        :return: Tuple (parsed value, True if dateutil was used,
+            error message if the string could not be parsed)
+        """
+
+        value = self.parse_fixed(s)
+        if value is not None:
+            return value, False, None
+        try:
+            return date_parser.parse(s), True, None
+        except Exception as x:
+            return None, True, str(x)
+
+    def snapshot(self) -> Tuple[Counter, Counter]:
+        return Counter(self.fallbacks), Counter(self.failures)
+
+    def restore(self, snapshot: Tuple[Counter, Counter]):
+        """
+        Restores the counters, e.g. before values are parsed again
+        """
+
+        self.fallbacks, self.failures = snapshot
+
+    def stats(self) -> Dict[str, Tuple[int, int]]:
+        """
+        :return: Dictionary mapping column names to tuples (number of
+            values parsed by dateutil, number of values that could
+            not be parsed)
+        """
+
+        return {
+            c: (self.fallbacks[c], self.failures[c])
+            for c in set(self.fallbacks) | set(self.failures)
+        }
+
+    def merge(self, stats: Dict[str, Tuple[int, int]]):
+        for c, (fallbacks, failures) in stats.items():
+            self.fallbacks[c] += fallbacks
+            self.failures[c] += failures
+
+    def report(self) -> List[str]:
+        return [
+            "{}: {:,d} dates parsed by dateutil, {:,d} failed".format(
+                c, fallbacks, failures
+            )
+            for c, (fallbacks, failures) in sorted(self.stats().items())
+        ]
+
+
+class RecordDecoder:
+    """
+    Decoder for fixed width records, compiled once for a given layout.
+
+    Column offsets and conversion functions are computed in the
+    constructor, so decoding a record neither looks up columns by name
+    nor branches on column types. The whole record is decoded with
+    a single call when it is pure ASCII, which is the case
+    for virtually all CMS records; otherwise every column is decoded
+    separately, exactly as before.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.slices = [(c.start, c.end) for c in self.columns]
+        self.dates = DateParser()
+        self.converters = [self.converter(c) for c in self.columns]
+
+    def converter(self, column):
+        if column.type == "NUM" and not column.d:
+            return to_int
+        if column.type == "DATE":
+            return partial(self.to_date, column.name)
+        return str
+
+    def to_date(self, column: str, s: str):
+        if s.strip():
+            return self.dates.parse(s, column)
+        return None
+
+    def split(self, data) -> List[str]:
+        """
+        Splits a record into column values
+
+        :param data: record as bytes or memoryview
+        :return: list of strings
+        """
+
+        try:
+            text = str(data, "ascii")
+        except UnicodeDecodeError:
+            return [str(data[s:e], "utf-8") for s, e in self.slices]
+        return [text[s:e] for s, e in self.slices]
+
+    def decode(self, data, ln) -> list:
+        pieces = self.split(data)
+        record = []
+        try:
+            for conv, s in zip(self.converters, pieces):
+                record.append(conv(s))
+            return record
+        except Exception as x:
+            return self.decode_with_errors(data, pieces, ln, record, x)
+
+    def decode_with_errors(self, data, pieces: List[str], ln,
+                           record: list = None,
+                           error: Exception = None) -> list:
+        """
+        Decodes a record, that contains bad values, logging them
+
+        :param record: Values that have been already converted, the
+            conversion continues with the next column, so that every
+            value is converted (and counted) only once
+        :param error: The exception raised by the conversion
+            of the column following the converted ones
+        """
+
+        exception_count = 0
+        record = list(record) if record else []
+        k = len(record)
+        for column, conv, s in zip(self.columns[k:], self.converters[k:],
+                                   pieces[k:]):
+            try:
+                if error is not None:
+                    x, error = error, None
+                    raise x
+                record.append(conv(s))
+            except Exception as x:
+                log("{:d}: {}[{:d}]: - {}".format(
+                    ln, column.name, column.ord, str(x))
+                )
+                record.append(s)
+                exception_count += 1
+                if exception_count > 3:
+                    log(bytes(data))
+                    raise MedparParseException("Too meany exceptions", column.start)
+        return record
+
+
 class MedicareFile:
     def __init__(self, dir_path: str, name: str,
-                 year:str = None, dest:str = None):
+                 year:str = None, dest:str = None, compression: str = GZIP):
         self.dir = dir_path
         if dest:
             if not os.path.exists(dest):
@@ -109,7 +315,8 @@ class MedicareFile:
             self.dest = self.dir
         self.name = os.path.join(self.dir, name)
         self.fts = '.'.join([self.name, "fts"])
-        self.csv = os.path.join(self.dest, '.'.join([name, "csv.gz"]))
+        self.compression = compression
+        self.csv = os.path.join(self.dest, '.'.join([name, "csv", compression]))
         if not os.path.isfile(self.fts):
             raise Exception("Not found: " + self.fts)
 
@@ -129,6 +336,14 @@ class MedicareFile:
         if not year:
             year = name[-4:]
         self.year = year
+        self.decoder = RecordDecoder(self.columns.values())
+        self.indices = dict()
+
+    def __getstate__(self):
+        # record indices can be large and are not sent to shard workers
+        state = self.__dict__.copy()
+        state["indices"] = dict()
+        return state
 
     def init(self):
         with open(self.fts) as fts:
@@ -155,39 +370,7 @@ class MedicareFile:
                 self.columns[column.name] = column
 
     def read_record(self, data, ln):
-        exception_count = 0
-        pieces = {}
-        for name in self.columns:
-            column = self.columns[name]
-            pieces[name] = data[column.start:column.end]
-        record = []
-        for name in self.columns:
-            column = self.columns[name]
-            s = pieces[name].decode("utf-8")
-            try:
-                if column.type == "NUM" and not column.d:
-                    val = s.strip()
-                    if val:
-                        record.append(int(val))
-                    else:
-                        record.append(None)
-                elif column.type == "DATE":
-                    if s.strip():
-                        record.append(date_parser.parse(s))
-                    else:
-                        record.append(None)
-                else:
-                    record.append(s)
-            except Exception as x:
-                log("{:d}: {}[{:d}]: - {}".format(
-                    ln, column.name, column.ord, str(x))
-                )
-                record.append(s)
-                exception_count += 1
-                if exception_count > 3:
-                    log(data)
-                    raise MedparParseException("Too meany exceptions", column.start)
-        return record
+        return self.decoder.decode(data, ln)
 
     def validate(self, record):
         yc = None
@@ -200,34 +383,24 @@ class MedicareFile:
         assert record[self.columns[yc].ord - 1] == self.year
 
     def count_lines_in_source(self):
+        """
+        Counts records in DAT files. Existing indices are used, but
+        no index is built or saved, so the source directories are
+        not modified
+        """
+
+        from cms.tools.mcr_index import RecordIndex
+
         lines = 0
-        blocks = 0
-        bts = 0
-        t1 = datetime.datetime.now()
-        t0 = t1
+        t0 = datetime.datetime.now()
         for dat in self.dat:
             print("{}: {}".format(t0.isoformat(), dat))
-            counter = 0
-            with open(dat, "rb") as source:
-                while source.readable():
-                    chunk = source.read(1024*1024)
-                    if len(chunk) < 1:
-                        break
-                    blocks += 1
-                    bts += len(chunk)
-                    n = chunk.count(b'\n')
-                    counter += n
-                    t2 = datetime.datetime.now()
-                    elapsed = t2 - t1
-                    if elapsed > datetime.timedelta(minutes=10):
-                        t1 = t2
-                        print(
-                            (
-                                "{} running for {}. Blocks = {:,}, lines = {:,}"
-                                + ", bytes = {:,}"
-                            ).format(dat, str(t2 - t0), blocks, counter, bts)
-                        )
-                print("{}: {:d}".format(os.path.basename(dat), counter))
+            index = self.indices.get(dat)
+            if index is not None:
+                counter = len(index)
+            else:
+                counter = RecordIndex.count_records(dat, self.block_size)
+            print("{}: {:d}".format(os.path.basename(dat), counter))
             lines += counter
         print("{}[Total]: {:d}".format(self.name, lines))
         return lines
@@ -236,20 +409,73 @@ class MedicareFile:
         lines = 0
         if not os.path.isfile(self.csv):
             return 0
-        with gzip.open(self.csv, "rt") as out:
+        with open_input(self.csv, "rt") as out:
             for _ in out:
                 lines += 1
         print("{}: {:d}".format(self.csv, lines))
         return lines
 
-    def status(self) -> str:
+    def expected_rows(self) -> Optional[int]:
+        """
+        :return: Number of records as declared in FTS file or None
+        """
+
+        value = self.metadata.get("Exact File Quantity (Rows)")
+        if value is None or not value.strip():
+            return None
+        return int(value.strip().replace(',', ''))
+
+    def estimated_rows(self) -> int:
+        """
+        Estimates the number of records in DAT files from their
+        sizes, without reading them
+        """
+
+        rows = 0
+        for dat in self.dat:
+            size = os.path.getsize(dat)
+            if size < self.block_size:
+                continue
+            stride = record_stride(dat, self.block_size)
+            rows += (size + stride - self.block_size) // stride
+        return rows
+
+    def status(self, verify: bool = False) -> str:
+        """
+        Returns conversion status. Unless verification is requested,
+        the status is computed from FTS metadata, sizes of DAT files
+        and the manifest written by export, without reading the data
+
+        :param verify: Count lines in the source and destination files
+        :return: NONE, IN PROGRESS, EMPTY, MISMATCH, UNVERIFIED, READY
+            or ERROR
+        """
+
         try:
+            manifest = ExportManifest.load(self.manifest_path)
+            if manifest is not None and not manifest.complete:
+                return "IN PROGRESS: {:.1f}%".format(manifest.percent())
             if not os.path.isfile(self.csv):
                 return "NONE"
-            l2 = self.count_lines_in_dest()
+            if verify:
+                return self.verify()
+            if manifest is None:
+                return "UNVERIFIED"
+            sources = {
+                os.path.basename(dat): os.path.getsize(dat)
+                for dat in self.dat
+            }
+            if sources != manifest.sources:
+                return "MISMATCH: source files have changed"
+            l1 = self.expected_rows()
+            if l1 is None:
+                l1 = self.estimated_rows()
+            elif sum(sources.values()) < l1 * self.block_size:
+                return "MISMATCH: {:d} rows do not fit in {:,d} bytes"\
+                    .format(l1, sum(sources.values()))
+            l2 = manifest.records
             if l2 < 1:
                 return "EMPTY"
-            l1 = self.count_lines_in_source()
             if l1 != l2:
                 return "MISMATCH: {:d}=>{:d}".format(l1, l2)
             return "READY"
@@ -258,59 +484,323 @@ class MedicareFile:
             traceback.print_exception(type(x), x, None)
             return "ERROR: " + str(x)
 
-    def status_message(self):
-        return "{}: {}".format(self.fts, self.status())
+    def verify(self) -> str:
+        """
+        Computes conversion status by counting lines in both
+        source and destination files
+        """
+
+        l2 = self.count_lines_in_dest()
+        if l2 < 1:
+            return "EMPTY"
+        l1 = self.count_lines_in_source()
+        if l1 != l2:
+            return "MISMATCH: {:d}=>{:d}".format(l1, l2)
+        return "READY"
 
-    def export(self):
+    def status_message(self, verify: bool = False):
+        return "{}: {}".format(self.fts, self.status(verify))
+
+    def copy_fts(self):
         if self.dir != self.dest:
             shutil.copy(self.fts, self.dest)
+
+    @property
+    def manifest_path(self) -> str:
+        return self.csv + ".manifest.json"
+
+    def open_manifest(self, checkpoint: int) -> ExportManifest:
+        """
+        Returns the manifest of a previous, possibly interrupted,
+        export if it has been done with the same source files and
+        checkpoint size, otherwise a new manifest
+        """
+
+        sources = {
+            os.path.basename(dat): os.path.getsize(dat) for dat in self.dat
+        }
+        manifest = ExportManifest.load(self.manifest_path)
+        if manifest is not None and not manifest.complete \
+                and manifest.compatible(sources, checkpoint):
+            return manifest
+        return ExportManifest(self.manifest_path, sources, checkpoint)
+
+    def export(self, batch_size: int = None, threads: int = None,
+               checkpoint: int = DEFAULT_CHECKPOINT, indexed: bool = False):
+        """
+        Converts DAT files to a compressed CSV file.
+
+        Every `checkpoint` records are written to a separate part
+        file and recorded in the manifest. If a previous export has
+        been interrupted, the parts that are recorded in its manifest
+        are not converted again.
+
+        :param batch_size: If specified, records are read and decoded
+            in vectorized batches of the given size
+        :param threads: Number of compression threads
+        :param checkpoint: Number of records in a part file
+        :param indexed: Build record index of DAT files before
+            conversion and use it to locate checkpoints and to
+            resynchronize after corrupted records
+        """
+
+        self.copy_fts()
+        manifest = self.open_manifest(checkpoint)
+        shards = self.shards(checkpoint, indexed)
+        parts = [self.part_path(i) for i in range(len(shards))]
+        for (dat, start, end), part in zip(shards, parts):
+            if manifest.is_done(part, dat, start, end):
+                print("{}: already converted".format(part))
+                continue
+            good, bad_lines, dates = self.export_shard(
+                dat, start, end, part, batch_size, threads
+            )
+            manifest.add(part, dat, start, end, good, bad_lines, dates)
+            manifest.save()
+            print("{}: {:.1f}% complete. Bad lines: {:,}".format(
+                self.fts, manifest.percent(), manifest.bad
+            ))
+        self.concatenate(parts)
+        manifest.finish()
+        manifest.save()
+        print("{} processed. Records: {:,}, bad lines: {:,}"
+              .format(self.fts, manifest.records, manifest.bad))
+        dates = DateParser()
+        dates.merge(manifest.date_stats())
+        for line in dates.report():
+            print("{}: {}".format(self.fts, line))
+
+    def export_records(self, dat: str, writer, offset: int = 0,
+                       counter: int = 0, end: int = None):
         t1 = datetime.datetime.now()
         t0 = t1
-        with gzip.open(self.csv, "wt") as out:
+        good = 0
+        bad_lines = 0
+        with DatReader(dat, self.block_size, offset, end,
+                       self.indices.get(dat)) as reader:
+            for data in reader:
+                try:
+                    record = self.read_record(data, counter)
+                    self.validate(record)
+                    writer.writerow(record)
+                    good += 1
+                except MedparParseException as x:
+                    log("Line = " + str(counter) + ':' + str(x.pos))
+                    bad_lines += 1
+                    log(x)
+                    reader.resync(x.pos)
+                except AssertionError as x:
+                    log("Line = " + str(counter))
+                    bad_lines += 1
+                    log(x)
+                data = None
+                counter += 1
+                if (counter%100000) == 0:
+                    t2 = datetime.datetime.now()
+                    t1 = t2
+                    print("{}[{}]: {:,}/{:,}/{:,}".format(
+                        dat, str(t2 - t0),
+                        counter, good, bad_lines
+                    ))
+        return good, bad_lines
+
+    def ordinal_at(self, dat: str, start: int) -> int:
+        """
+        Ordinal number of the record starting at a given offset,
+        assuming all records of the DAT file have the same length
+        """
+
+        return start // record_stride(dat, self.block_size)
+
+    def export_batches(self, dat: str, writer, batch_size: int,
+                       start: int = 0, end: int = None):
+        from cms.tools.mcr_batch import BatchDecoder
+
+        decoder = BatchDecoder(
+            self.columns.values(),
+            self.block_size,
+            record_stride(dat, self.block_size)
+        )
+        # count dates parsed record by record together with ours
+        decoder.decoder = self.decoder
+        t0 = datetime.datetime.now()
+        counter = self.ordinal_at(dat, start)
+        good = 0
+        bad_lines = 0
+        offset = start
+        dates = self.decoder.dates
+        for offset, buffer, n in decoder.read(dat, batch_size, start, end):
+            snapshot = dates.snapshot()
+            try:
+                records = decoder.decode(buffer, n)
+            except Exception:
+                # the batch is decoded again record by record
+                dates.restore(snapshot)
+                records = None
+            for i in range(n):
+                try:
+                    if records is None:
+                        record = self.read_record(decoder.record(buffer, i),
+                                                  counter)
+                    else:
+                        record = records[i]
+                    self.validate(record)
+                    writer.writerow(record)
+                    good += 1
+                except (MedparParseException, AssertionError) as x:
+                    log("Line = " + str(counter))
+                    bad_lines += 1
+                    log(x)
+                counter += 1
+            offset += n * decoder.stride
+            print("{}[{}]: {:,}/{:,}/{:,}".format(
+                dat, str(datetime.datetime.now() - t0),
+                counter, good, bad_lines
+            ))
+        # The tail of the file, or the rest of it, if the records
+        # are not aligned, is processed record by record
+        g, b = self.export_records(dat, writer, offset, counter, end)
+        return good + g, bad_lines + b
+
+    def shards(self, shard_size: int, indexed: bool = False) \
+            -> List[Tuple[str, int, int]]:
+        """
+        Splits DAT files into byte ranges, each containing about
+        `shard_size` records. Every range starts at a record boundary.
+
+        :param shard_size: number of records in a shard
+        :param indexed: If True, the files are scanned to build
+            a record index and every shard contains exactly `shard_size`
+            records, even if some records are not of the declared length.
+            Otherwise, the boundaries are computed from the record length
+        :return: list of tuples (dat file, start offset, end offset)
+        """
+
+        result = []
+        for dat in self.dat:
+            if indexed:
+                ranges = self.record_index(dat).shards(shard_size)
+            else:
+                ranges = shard_ranges(dat, self.block_size, shard_size)
+            for start, end in ranges:
+                result.append((dat, start, end))
+        return result
+
+    def record_index(self, dat: str, key: str = None):
+        """
+        Returns record index of a DAT file. The index is loaded from
+        its sidecar file, if it is up to date, otherwise it is built
+        and saved
+
+        :param dat: Path to DAT file
+        :param key: If specified, the index must include this
+            key column
+        :return: :class:`cms.tools.mcr_index.RecordIndex`
+        """
+
+        from cms.tools.mcr_index import RecordIndex
+
+        index = self.indices.get(dat)
+        if index is None:
+            index = RecordIndex.open(dat, self.block_size)
+        if key is not None and index.key != key:
+            if key not in self.columns:
+                raise ValueError("Column {} is not defined in {}".format(
+                    key, self.fts
+                ))
+            column = self.columns[key]
+            index.build_keys(key, column.start, column.end, self.block_size)
+            index.try_save()
+        self.indices[dat] = index
+        return index
+
+    def extract(self, keys: Iterable[str] = None,
+                ordinals: Iterable[int] = None,
+                key: str = "BENE_ID") -> Iterator[list]:
+        """
+        Reads selected records using record indices, without
+        scanning DAT files
+
+        :param keys: Values of the key column
+        :param ordinals: Ordinal numbers of records, counting
+            through all DAT files
+        :param key: Key column
+        :return: Decoded records in the order of the files
+        :raises ValueError: if some ordinal numbers are beyond
+            the last record
+        """
+
+        wanted = set(ordinals) if ordinals else set()
+        indices = [
+            (dat, self.record_index(dat, key if keys else None))
+            for dat in self.dat
+        ]
+        total = sum(index.count(self.block_size) for _, index in indices)
+        missing = sorted(o for o in wanted if o < 0 or o >= total)
+        if missing:
+            raise ValueError(
+                "Records {} are not found in {}: it has {:,d} records"
+                .format(", ".join(str(o) for o in missing), self.fts, total)
+            )
+        first = 0
+        for dat, index in indices:
+            n = index.count(self.block_size)
+            selected = {o - first for o in wanted if first <= o < first + n}
+            for k in keys or []:
+                selected.update(int(o) for o in index.find(k))
+            first += n
+            if not selected:
+                continue
+            with DatReader(dat, self.block_size) as reader:
+                for o in sorted(selected):
+                    data = reader.block(index.offset(o), self.block_size)
+                    try:
+                        yield self.read_record(data, o)
+                    except MedparParseException as x:
+                        log("{}: record {:d}: {}".format(dat, o, str(x)))
+
+    def part_path(self, i: int) -> str:
+        return "{}.part{:05d}".format(self.csv, i)
+
+    def export_shard(self, dat: str, start: int, end: int, part: str,
+                     batch_size: int = None, threads: int = 1):
+        """
+        Converts a byte range of a DAT file into a separate compressed
+        part file
+
+        :return: tuple (number of good records, number of bad records,
+            date parsing statistics)
+        """
+
+        self.decoder.dates = DateParser()
+        with open_output(part, "wt", threads=threads, codec=self.compression) \
+                as out:
             writer = csv.writer(out, quoting=csv.QUOTE_MINIMAL, delimiter='\t')
-            for dat in self.dat:
-                print(dat)
-                counter = 0
-                good = 0
-                bad_lines = 0
-                remainder = b''
-                with open(dat, "rb") as source:
-                    while source.readable():
-                        l = self.block_size - len(remainder) + 100
-                        block = remainder + source.read(l)
-                        if len(block) < self.block_size:
-                            break
-                        idx = self.block_size
-                        try:
-                            record = self.read_record(block[:idx], counter)
-                            self.validate(record)
-                            writer.writerow(record)
-                            good += 1
-                        except MedparParseException as x:
-                            log("Line = " + str(counter) + ':' + str(x.pos))
-                            bad_lines += 1
-                            log(x)
-                            for idx in range(x.pos, self.block_size):
-                                if block[idx] in [10, 13]:
-                                    break
-                        except AssertionError as x:
-                            log("Line = " + str(counter))
-                            bad_lines += 1
-                            log(x)
-                        while idx < len(block) and block[idx] in [10, 13]:
-                            idx += 1
-                        remainder = block[idx:]
-                        block = None
-                        counter += 1
-                        if (counter%100000) == 0:
-                            t2 = datetime.datetime.now()
-                            t1 = t2
-                            print("{}[{}]: {:,}/{:,}/{:,}".format(
-                                dat, str(t2 - t0),
-                                counter, good, bad_lines
-                            ))
-                print("{} processed. Bad lines: {:,}"
-                      .format(self.fts, bad_lines))
+            if batch_size:
+                good, bad_lines = self.export_batches(
+                    dat, writer, batch_size, start, end
+                )
+            else:
+                good, bad_lines = self.export_records(
+                    dat, writer, start, self.ordinal_at(dat, start), end
+                )
+        return good, bad_lines, self.decoder.dates.stats()
+
+    def concatenate(self, parts: List[str]):
+        """
+        Concatenates compressed part files into the destination CSV file.
+        Concatenation of gzip members (as well as of zstd or lz4 frames)
+        is itself a valid compressed file.
+        """
+
+        tmp = self.csv + ".tmp"
+        with open(tmp, "wb") as out:
+            for part in parts:
+                with open(part, "rb") as src:
+                    shutil.copyfileobj(src, out, 1024*1024)
+        os.replace(tmp, self.csv)
+        for part in parts:
+            os.remove(part)
 
     def info(self):
         for s in [
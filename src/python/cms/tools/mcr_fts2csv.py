@@ -18,15 +18,34 @@
 #
 import csv
 import datetime
-import gzip
 import os
 import sys
 
 from cms.fts2yaml import MedicareFTS, mcr_type
+from cms.tools.compression import open_output
+from cms.tools.mcr_dat import record_stride
 from nsaph_utils.utils.fwf import FWFReader
 
 
-def convert(fts_path: str):
+def write(records, writer, t0) -> int:
+    n = 0
+    for record in records:
+        writer.writerow(record)
+        n += 1
+        if (n % 100000) == 0:
+            print("{:,}: {}".format(n, str(datetime.datetime.now() - t0)))
+    return n
+
+
+def convert(fts_path: str, batch_size: int = None):
+    """
+    Converts a DAT file described by FTS file into gzipped CSV
+
+    :param fts_path: path to FTS file
+    :param batch_size: If specified, records are read and decoded
+        in vectorized batches of the given size
+    """
+
     f, ext = os.path.splitext(fts_path)
     basedir, fname = os.path.split(f)
     t = mcr_type(fname)
@@ -34,18 +53,23 @@ def convert(fts_path: str):
     csv_path = f + ".csv.gz"
 
     fts = MedicareFTS(t).init(fts_path)
+    meta = fts.to_fwf_meta(dat_path)
     t0 = datetime.datetime.now()
-    with FWFReader(fts.to_fwf_meta(dat_path)) as reader,\
-        gzip.open(csv_path, "wt") as out:
+    with open_output(csv_path, "wt") as out:
         writer = csv.writer(out)
-        n = 0
-        for record in reader:
-            writer.writerow(record)
-            n += 1
-            if (n % 100000) == 0:
-                print("{:,}: {}".format(n, str(datetime.datetime.now() - t0)))
+        if batch_size:
+            from cms.tools.mcr_batch import BatchDecoder
+            decoder = BatchDecoder(
+                meta.columns,
+                meta.record_len,
+                record_stride(dat_path, meta.record_len)
+            )
+            write(decoder.records(dat_path, batch_size), writer, t0)
+        else:
+            with FWFReader(meta) as reader:
+                write(reader, writer, t0)
     return
 
 
 if __name__ == '__main__':
-    convert(sys.argv[1])
+    convert(sys.argv[1], *[int(a) for a in sys.argv[2:3]])
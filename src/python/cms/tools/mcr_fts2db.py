@@ -16,18 +16,24 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import concurrent.futures
 import copy
 import glob
 import logging
 import os
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
 
+from cms.csv_loader import CSVLoader
 from cms.mcr_data_loader import MedicareDataLoader
 from cms.registry import Registry
 
 from cms.create_schema_config import CMSSchema
 
-from cms.fts2yaml import mcr_type
+from cms.fts2yaml import mcr_type, find_files, MedicareFTS, CMSFTS
+from cms.tools.compression import CODECS
+from cms.tools.options import split_arguments, loader_parser
 from nsaph.loader.data_loader import DataLoader
 
 from nsaph.loader import LoaderConfig
@@ -43,11 +49,30 @@ class MedicareLoader:
     """
 
     @classmethod
-    def process(cls):
-        loader = MedicareLoader()
+    def process(cls, copy_format: str = None, concurrency: int = None,
+                max_connections: int = None, memory_map: bool = False):
+        loader = MedicareLoader(copy_format, concurrency, max_connections,
+                                memory_map)
         loader.traverse(loader.pattern)
 
-    def __init__(self):
+    def __init__(self, copy_format: str = None, concurrency: int = None,
+                 max_connections: int = None, memory_map: bool = False):
+        """
+        :param copy_format: If specified ("text" or "binary"), DAT files
+            are streamed into the database with COPY in this format
+        :param memory_map: Read DAT files through memory mapping
+        :param concurrency: Number of tables loaded at the same time,
+            by default the tables are loaded one after another
+        :param max_connections: Total number of database connections
+            (i.e. loader threads or COPY workers), shared by the tables
+            loaded at the same time. By default, every table uses
+            the number of threads given in the configuration
+        """
+
+        self.copy_format = copy_format
+        self.memory_map = memory_map
+        self.concurrency = concurrency
+        self.max_connections = max_connections
         self.pattern = "**/*.fts"
         self.context = LoaderConfig(__doc__)
         self.context.domain = "cms"
@@ -67,58 +92,238 @@ class MedicareLoader:
         else:
             dirs = [self.root_dir]
         files: List[str] = []
+        _, name_pattern = os.path.split(pattern)
         for d in dirs:
             if os.path.isfile(d):
                 files.append(d)
             else:
-                files.extend(glob.glob(os.path.join(d, pattern), recursive=True))
-        for f in files:
+                files.extend(find_files(d, name_pattern))
+        schemas = self.read_all(files)
+        registered = self.update_registry(schemas)
+        if self.concurrency and self.concurrency > 1:
+            self.load_concurrently(schemas, registered)
+            return
+        for f in schemas:
             try:
-                self.handle(f)
+                self.handle(f, schemas[f], registered=registered)
             except Exception as x:
                 logging.exception("Error handling {}. Ignoring.".format(str(f)))
         return
 
-    def handle(self, fts_path: str):
+    @staticmethod
+    def data_size(fts_path: str, fts: MedicareFTS) -> int:
+        """
+        Size of the data described by an FTS file: as declared by
+        the FTS file or, if not declared, the size of data files
+        """
+
+        key = "Exact File Size in Bytes with 512 Blocksize"
+        try:
+            return CMSFTS.v2i(fts.metadata[key])
+        except (KeyError, ValueError):
+            f, _ = os.path.splitext(fts_path)
+            return sum(
+                os.path.getsize(p) for p in glob.glob("{}*.dat".format(f))
+            )
+
+    def load_concurrently(self, schemas: Dict[str, MedicareFTS],
+                          registered: bool = True):
+        """
+        Loads several tables at the same time. The largest tables are
+        started first, so that the small ones fill the gaps at the end.
+        Every table gets an equal share of database connections.
+
+        :param schemas: Parsed FTS files
+        :param registered: True if the tables have been already added
+            to the registry
+        """
+
+        jobs = sorted(
+            schemas, key=lambda f: self.data_size(f, schemas[f]), reverse=True
+        )
+        concurrency = self.concurrency
+        threads = None
+        if self.max_connections:
+            # Never run more tables at once than there are connections,
+            # otherwise every table would still take one connection
+            # and the total would exceed the limit
+            concurrency = min(concurrency, self.max_connections)
+            threads = self.max_connections // concurrency
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self.timed_handle, f, schemas[f], threads, registered
+                ): f
+                for f in jobs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                f = futures[future]
+                try:
+                    print(future.result())
+                except Exception as x:
+                    logging.exception("Error handling {}. Ignoring.".format(str(f)))
+        print("Loaded {:d} tables in {:.1f} sec".format(
+            len(jobs), time.perf_counter() - t0
+        ))
+
+    def timed_handle(self, fts_path: str, fts: MedicareFTS,
+                     threads: int = None, registered: bool = True) -> str:
+        """
+        Loads a table and returns a message with its throughput.
+        Rows are counted as loaded when the data is copied, otherwise
+        the number of rows declared in the FTS file is reported
+        """
+
+        t0 = time.perf_counter()
+        loader = self.handle(fts_path, fts, registered=registered,
+                             threads=threads)
+        elapsed = max(time.perf_counter() - t0, 1e-6)
+        rows = getattr(loader, "copied", None)
+        if rows is not None:
+            label = "rows loaded"
+        else:
+            label = "rows declared in FTS"
+            key = "Exact File Quantity (Rows)"
+            try:
+                rows = CMSFTS.v2i(fts.metadata[key])
+            except (KeyError, ValueError):
+                rows = 0
+        size = self.data_size(fts_path, fts)
+        return "{}: {:,d} {}, {:,.1f} MB in {:.1f} sec: " \
+               "{:,.0f} rows/sec, {:,.1f} MB/sec".format(
+                    fts.table_name, rows, label, size / 1e6, elapsed,
+                    rows / elapsed, size / 1e6 / elapsed
+                )
+
+    def read_all(self, files: List[str]) -> Dict[str, MedicareFTS]:
+        """
+        Parses FTS files in parallel threads. Files that cannot be
+        parsed are reported and ignored.
+
+        :return: Dictionary of parsed files, in the order of the files
+        """
+
+        schemas = dict()
+        with ThreadPoolExecutor() as executor:
+            futures = {f: executor.submit(self.read_fts, f) for f in files}
+            for f in files:
+                try:
+                    schemas[f] = futures[f].result()
+                except Exception as x:
+                    logging.exception("Error handling {}. Ignoring.".format(str(f)))
+        return schemas
+
+    def update_registry(self, schemas: Dict[str, MedicareFTS]) -> bool:
+        """
+        Adds all tables to the registry at once. Tables that cannot
+        be added are removed from `schemas` and are not loaded
+
+        :param schemas: Parsed FTS files
+        :return: False if the registry could not be updated at once,
+            then every table has to be registered separately
+        """
+
+        ctxt = CMSSchema(None,
+                         path=self.context.registry,
+                         inpt=None,
+                         tp= "medicare",
+                         reset=False)
+        try:
+            failed = Registry(ctxt).update_batch(list(schemas.values()))
+        except Exception:
+            logging.exception("Error updating the registry. "
+                              "Registering tables one by one.")
+            return False
+        for f in [f for f in schemas if schemas[f] in failed]:
+            del schemas[f]
+        return True
+
+    @staticmethod
+    def read_fts(fts_path: str) -> MedicareFTS:
+        return MedicareFTS(mcr_type(os.path.basename(fts_path))).init(fts_path)
+
+    def handle(self, fts_path: str, fts: MedicareFTS = None,
+               registered: bool = False, threads: int = None) -> DataLoader:
+        """
+        Updates the registry with the table described by an FTS file
+        and loads the data
+
+        :param fts_path: Path to FTS file
+        :param fts: Parsed FTS file, if it has been already read
+        :param registered: True if the table has been already added
+            to the registry
+        :param threads: Number of loader threads (database connections),
+            overrides the configuration
+        :return: The loader, that has loaded the data
+        """
+
         basedir, fname = os.path.split(fts_path)
         _, ydir = os.path.split(basedir)
         year = int(ydir)
         f, ext = os.path.splitext(fts_path)
         ttype = mcr_type(fname)
-        ctxt = CMSSchema(None,
-                         path=self.context.registry,
-                         inpt=fts_path,
-                         tp= "medicare",
-                         reset=False)
-        reg = Registry(ctxt)
-        reg.update()
+        if not registered:
+            ctxt = CMSSchema(None,
+                             path=self.context.registry,
+                             inpt=fts_path,
+                             tp= "medicare",
+                             reset=False)
+            reg = Registry(ctxt, fts)
+            reg.update()
         context = copy.deepcopy(self.context)
         context.table = "{}_{:d}".format(ttype, year)
+        if threads:
+            context.threads = threads
 
-        if os.path.isfile(f + ".csv.gz"):
-            loader = self.loader_for_csv(context, f + ".csv.gz")
+        csv_files = [
+            f + ".csv." + codec for codec in CODECS
+            if os.path.isfile(f + ".csv." + codec)
+        ]
+        if csv_files:
+            loader = self.loader_for_csv(context, csv_files[0])
         elif glob.glob("{}*.dat".format(f)):  #os.path.isfile(f + ".dat"):
-            loader = self.loader_for_fwf(context, fts_path)
+            loader = self.loader_for_fwf(context, fts_path, self.copy_format,
+                                         self.memory_map)
         else:
             raise ValueError("Data file was not found: " + f)
         if self.context.dryrun:
             print("Dry run: " + fts_path)
         else:
             loader.run()
+        return loader
 
     @staticmethod
     def loader_for_csv(context: LoaderConfig, data_path: str) -> DataLoader:
         context.pattern = [os.path.join("**", os.path.basename(data_path))]
-        loader = DataLoader(context)
+        loader = CSVLoader(context)
         loader.csv_delimiter = '\t'
         return loader
 
     @staticmethod
-    def loader_for_fwf(context: LoaderConfig, fts_path: str) -> DataLoader:
+    def loader_for_fwf(context: LoaderConfig, fts_path: str,
+                       copy_format: str = None,
+                       memory_map: bool = False) -> DataLoader:
         context.data = [fts_path]
-        loader = MedicareDataLoader(context)
+        loader = MedicareDataLoader(context, memory_map=memory_map,
+                                    copy_format=copy_format)
         return loader
 
 
+def args():
+    parser = loader_parser()
+    parser.add_argument("--concurrency", type=int,
+                        help="Number of tables loaded at the same time")
+    parser.add_argument("--max-connections", type=int,
+                        dest="max_connections",
+                        help="Total number of database connections, "
+                             "shared by the tables loaded at the same time")
+    return split_arguments(parser)
+
+
 if __name__ == '__main__':
-    MedicareLoader.process()
+    options = args()
+    MedicareLoader.process(copy_format=options.copy_format,
+                           concurrency=options.concurrency,
+                           max_connections=options.max_connections,
+                           memory_map=options.memory_map)
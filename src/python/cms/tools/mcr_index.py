@@ -0,0 +1,414 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Index of record boundaries in DAT files.
+
+A DAT file is scanned once: blocks of the memory mapped file are
+viewed as NumPy arrays and line terminators are located with
+vectorized comparisons. The offsets of the records (i.e. of the
+first bytes following a sequence of line terminators) are kept
+in a compact uint64 array, that is used to count records,
+to resynchronize after a corrupted record and to split a file into
+shards with exactly the same number of records. For files without
+line terminators the offsets are computed from the record length.
+
+An index can be saved in a sidecar file next to the DAT file
+(with `.idx` suffix) and optionally include a sorted copy of a key
+column, e.g. BENE_ID. Such index gives access to a record by its
+ordinal number or by the key with a binary search, without
+scanning the file. The sidecar is ignored if the DAT file has
+been modified after the index was built.
+"""
+
+import csv
+import mmap
+import os
+from argparse import ArgumentParser
+from typing import List, Tuple, Optional, Iterator
+
+import numpy
+
+from cms.tools.mcr_dat import NEWLINE_BYTES, record_stride
+
+
+DEFAULT_SCAN_BLOCK = 64 * 1024 * 1024
+INDEX_SUFFIX = ".idx"
+
+
+def is_terminator(a: numpy.ndarray) -> numpy.ndarray:
+    return (a == NEWLINE_BYTES[0]) | (a == NEWLINE_BYTES[1])
+
+
+class RecordIndex:
+    """
+    Offsets of the records in a DAT file
+    """
+
+    def __init__(self, path: str, starts: numpy.ndarray = None):
+        """
+        :param path: Path to DAT file
+        :param starts: Record offsets, if they are already known
+        """
+
+        self.path = path
+        self.starts = starts
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        self.key = None
+        self.keys: Optional[numpy.ndarray] = None
+        self.order: Optional[numpy.ndarray] = None
+
+    @property
+    def index_path(self) -> str:
+        return self.path + INDEX_SUFFIX
+
+    @staticmethod
+    def unterminated(path: str, size: int, record_len: int = None) -> bool:
+        """
+        Checks if records of a DAT file follow each other without
+        line terminators
+        """
+
+        if not record_len or size <= record_len:
+            return False
+        return record_stride(path, record_len) == record_len
+
+    @staticmethod
+    def fixed_count(size: int, record_len: int) -> int:
+        """
+        Number of records in a file without line terminators
+        """
+
+        return (size - record_len) // record_len + 1
+
+    @classmethod
+    def load(cls, path: str, record_len: int = None) \
+            -> Optional['RecordIndex']:
+        """
+        Loads index of a DAT file from its sidecar file
+
+        :param path: Path to DAT file
+        :param record_len: Length of a record, if given, the index of
+            a file without line terminators is checked to contain
+            every record
+        :return: The index or None if the sidecar does not exist,
+            is older than the DAT file or is incomplete
+        """
+
+        index = RecordIndex(path)
+        if not os.path.isfile(index.index_path):
+            return None
+        with numpy.load(index.index_path) as content:
+            size, mtime = content["stamp"].tolist()
+            if size != index.size or mtime != index.mtime:
+                return None
+            index.starts = content["starts"]
+            if "keys" in content:
+                index.key = str(content["key"][0])
+                index.keys = content["keys"]
+                index.order = content["order"]
+        if cls.unterminated(path, index.size, record_len) and \
+                len(index) != cls.fixed_count(index.size, record_len):
+            return None
+        return index
+
+    @classmethod
+    def open(cls, path: str, record_len: int = None) -> 'RecordIndex':
+        """
+        Loads index of a DAT file or builds it and tries to save it
+
+        :param path: Path to DAT file
+        :param record_len: Length of a record, required to index
+            files without line terminators
+        """
+
+        index = cls.load(path, record_len)
+        if index is None:
+            index = cls.build(path, record_len)
+            index.try_save()
+        return index
+
+    def save(self):
+        arrays = {
+            "starts": self.starts,
+            "stamp": numpy.array([self.size, self.mtime], dtype=numpy.int64)
+        }
+        if self.keys is not None:
+            arrays["key"] = numpy.array([self.key])
+            arrays["keys"] = self.keys
+            arrays["order"] = self.order
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            numpy.savez(f, **arrays)
+        os.replace(tmp, self.index_path)
+
+    def try_save(self) -> bool:
+        """
+        Saves the index unless the directory is not writable
+        """
+
+        try:
+            self.save()
+            return True
+        except OSError as x:
+            print("Index is not saved: {}: {}".format(self.index_path, str(x)))
+            return False
+
+    @staticmethod
+    def scan(path: str, size: int, block_size: int = DEFAULT_SCAN_BLOCK) \
+            -> Iterator[numpy.ndarray]:
+        """
+        Scans a DAT file block by block
+
+        :param path: Path to DAT file
+        :param size: Size of the file
+        :param block_size: Number of bytes examined at once
+        :return: Iterator over arrays of the offsets of the records,
+            starting in each block
+        """
+
+        if size == 0:
+            return
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            try:
+                # a virtual terminator before the first byte
+                previous = True
+                for offset in range(0, size, block_size):
+                    n = min(block_size, size - offset)
+                    block = numpy.frombuffer(
+                        mm, dtype=numpy.uint8, count=n, offset=offset
+                    )
+                    term = is_terminator(block)
+                    # record starts where a terminator is followed by
+                    # any other byte
+                    first = numpy.flatnonzero(
+                        term[:-1] & ~term[1:]
+                    ).astype(numpy.uint64) + numpy.uint64(offset + 1)
+                    if previous and not term[0]:
+                        yield numpy.array([offset], dtype=numpy.uint64)
+                    yield first
+                    previous = bool(term[-1])
+                    del block, term
+            finally:
+                mm.close()
+
+    @classmethod
+    def build(cls, path: str, record_len: int = None,
+              block_size: int = DEFAULT_SCAN_BLOCK) -> 'RecordIndex':
+        """
+        Scans a DAT file and builds its index
+
+        :param path: Path to DAT file
+        :param record_len: Length of a record, required to index
+            files without line terminators
+        :param block_size: Number of bytes examined at once
+        :return: Index of the file
+        """
+
+        index = RecordIndex(path)
+        if cls.unterminated(path, index.size, record_len):
+            index.starts = numpy.arange(
+                0, index.size - record_len + 1, record_len,
+                dtype=numpy.uint64
+            )
+            return index
+        chunks = list(cls.scan(path, index.size, block_size))
+        if not chunks:
+            index.starts = numpy.zeros(0, dtype=numpy.uint64)
+            return index
+        index.starts = numpy.concatenate(chunks)
+        return index
+
+    @classmethod
+    def count_records(cls, path: str, record_len: int = None,
+                      block_size: int = DEFAULT_SCAN_BLOCK) -> int:
+        """
+        Counts records in a DAT file. Uses the sidecar index if it is
+        up to date, otherwise scans the file without keeping
+        the offsets and without saving the index
+
+        :param path: Path to DAT file
+        :param record_len: Length of a record, required to count
+            records in files without line terminators
+        :param block_size: Number of bytes examined at once
+        :return: Number of records
+        """
+
+        index = cls.load(path, record_len)
+        if index is not None:
+            return len(index)
+        size = os.path.getsize(path)
+        if cls.unterminated(path, size, record_len):
+            return cls.fixed_count(size, record_len)
+        return sum(
+            len(chunk)
+            for chunk in cls.scan(path, size, block_size)
+        )
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def count(self, record_len: int = 1) -> int:
+        """
+        Number of records that are at least `record_len` bytes long
+        till the end of the file, i.e. can be read with DatReader
+        """
+
+        limit = self.size - record_len
+        if limit < 0:
+            return 0
+        return int(numpy.searchsorted(
+            self.starts, numpy.uint64(limit), side="right"
+        ))
+
+    def next_start(self, pos: int) -> Optional[int]:
+        """
+        Returns the offset of the first record starting after
+        a given position or None if there is no such record
+        """
+
+        i = int(numpy.searchsorted(self.starts, numpy.uint64(pos),
+                                   side="right"))
+        if i < len(self.starts):
+            return int(self.starts[i])
+        return None
+
+    def shards(self, shard_size: int) -> List[Tuple[int, int]]:
+        """
+        Splits the file into byte ranges containing exactly
+        `shard_size` records, except the last one
+
+        :return: list of tuples (start offset, end offset)
+        """
+
+        if len(self.starts) == 0:
+            return []
+        starts = [int(s) for s in self.starts[::shard_size]]
+        starts[0] = 0
+        return list(zip(starts, starts[1:] + [self.size]))
+
+    def offset(self, ordinal: int) -> int:
+        return int(self.starts[ordinal])
+
+    def build_keys(self, key: str, start: int, end: int, record_len: int,
+                   chunk: int = 1024 * 1024):
+        """
+        Reads a key column of every record and sorts the records
+        by the key
+
+        :param key: Name of the key column
+        :param start: Position of the column in a record
+        :param end: Position of the first byte after the column
+        :param record_len: Length of a record
+        :param chunk: Number of records read at once
+        """
+
+        n = self.count(record_len)
+        keys = numpy.empty(n, dtype="S{:d}".format(end - start))
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = numpy.frombuffer(mm, dtype=numpy.uint8)
+                columns = numpy.arange(start, end, dtype=numpy.uint64)
+                rows = None
+                for i in range(0, n, chunk):
+                    rows = self.starts[i:i + chunk, None] + columns
+                    keys[i:i + chunk] = data[rows].view(keys.dtype).ravel()
+                del data, rows
+            finally:
+                mm.close()
+        order = numpy.argsort(keys, kind="stable")
+        self.key = key
+        self.keys = keys[order]
+        self.order = order.astype(numpy.uint64)
+
+    def find(self, value: str) -> numpy.ndarray:
+        """
+        Looks up records by the value of the key column
+
+        :param value: The value of the key, trailing spaces are optional
+        :return: Sorted ordinal numbers of the records
+        """
+
+        if self.keys is None:
+            raise ValueError("Index is not keyed: " + self.index_path)
+        width = self.keys.dtype.itemsize
+        k = value.encode("utf-8").ljust(width)[:width]
+        lo = numpy.searchsorted(self.keys, k, side="left")
+        hi = numpy.searchsorted(self.keys, k, side="right")
+        return numpy.sort(self.order[lo:hi])
+
+
+def args():
+    parser = ArgumentParser ("Builds record indices for DAT files and "
+                             "extracts records by the index")
+    parser.add_argument(help="Path to an FTS file", dest="fts")
+    parser.add_argument("--key", default="BENE_ID",
+                        help="Key column to index")
+    parser.add_argument("--bene", "-b", nargs='*', default=[],
+                        help="Key values of records to extract")
+    parser.add_argument("--bene-file", dest="bene_file",
+                        help="File with key values, one per line")
+    parser.add_argument("--ordinal", "-n", type=int, nargs='*', default=[],
+                        help="Ordinal numbers of records to extract")
+    parser.add_argument("--output", "-o",
+                        help="Output file, the records are printed if "
+                             "not specified")
+    arguments = parser.parse_args()
+    return arguments
+
+
+def main():
+    from cms.tools.compression import open_output
+    from cms.tools.mcr_file import MedicareFile
+
+    my_args = args()
+    f, _ = os.path.splitext(my_args.fts)
+    dir_path, name = os.path.split(f)
+    mfile = MedicareFile(dir_path, name)
+    keys = list(my_args.bene)
+    if my_args.bene_file:
+        with open(my_args.bene_file) as bf:
+            keys.extend(line.strip() for line in bf if line.strip())
+    for dat in mfile.dat:
+        index = mfile.record_index(dat, my_args.key)
+        print("{}: {:,d} records".format(dat, len(index)))
+    if not keys and not my_args.ordinal:
+        return
+    records = mfile.extract(
+        keys=keys, ordinals=my_args.ordinal, key=my_args.key
+    )
+    if my_args.output:
+        with open_output(my_args.output, "wt") as out:
+            writer = csv.writer(out, quoting=csv.QUOTE_MINIMAL,
+                                delimiter='\t')
+            for record in records:
+                writer.writerow(record)
+    else:
+        for record in records:
+            print(record)
+
+
+if __name__ == '__main__':
+    main()
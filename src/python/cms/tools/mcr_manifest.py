@@ -0,0 +1,181 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Progress manifest for conversion of DAT files to CSV.
+
+Conversion writes a sequence of compressed part files, one per
+checkpoint. When a part is complete, its description (byte range
+of the source DAT file, number of records, size and checksum of the
+part file) is added to a JSON manifest, that is saved atomically.
+If the conversion is interrupted, it is resumed with the first part
+that is not recorded in the manifest or does not match its checksum.
+"""
+
+import json
+import os
+import zlib
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+
+def file_checksum(path: str) -> str:
+    """
+    Returns CRC32 of a file as a hex string
+    """
+
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024*1024)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return "{:08x}".format(crc & 0xffffffff)
+
+
+class ExportManifest:
+    """
+    Manifest of part files written while converting DAT files
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, sources: Dict[str, int], checkpoint: int):
+        """
+        :param path: Path to the manifest file
+        :param sources: Dictionary mapping names of DAT files to
+            their sizes
+        :param checkpoint: Number of records in a part
+        """
+
+        self.path = path
+        self.sources = sources
+        self.checkpoint = checkpoint
+        self.parts: Dict[str, dict] = dict()
+        self.complete = False
+
+    @classmethod
+    def load(cls, path: str) -> Optional['ExportManifest']:
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            content = json.load(f)
+        if content.get("version") != cls.VERSION:
+            return None
+        manifest = ExportManifest(
+            path, content["sources"], content["checkpoint"]
+        )
+        manifest.parts = content["parts"]
+        manifest.complete = content["complete"]
+        return manifest
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump({
+                "version": self.VERSION,
+                "sources": self.sources,
+                "checkpoint": self.checkpoint,
+                "complete": self.complete,
+                "parts": self.parts
+            }, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def compatible(self, sources: Dict[str, int], checkpoint: int) -> bool:
+        """
+        Checks that the manifest has been created for the same
+        source files and the same checkpoint size
+        """
+
+        return self.sources == sources and self.checkpoint == checkpoint
+
+    def is_done(self, part: str, dat: str, start: int, end: int) -> bool:
+        """
+        Checks if a part file is recorded in the manifest and
+        has not been modified since
+        """
+
+        entry = self.parts.get(os.path.basename(part))
+        if entry is None:
+            return False
+        if (entry["dat"], entry["start"], entry["end"]) \
+                != (os.path.basename(dat), start, end):
+            return False
+        if not os.path.isfile(part) or os.path.getsize(part) != entry["size"]:
+            return False
+        return file_checksum(part) == entry["crc32"]
+
+    def add(self, part: str, dat: str, start: int, end: int,
+            good: int, bad: int, dates: Dict[str, Tuple[int, int]]):
+        """
+        Records a complete part file
+        """
+
+        self.parts[os.path.basename(part)] = {
+            "dat": os.path.basename(dat),
+            "start": start,
+            "end": end,
+            "records": good,
+            "bad": bad,
+            "size": os.path.getsize(part),
+            "crc32": file_checksum(part),
+            "dates": dates
+        }
+
+    def finish(self):
+        self.complete = True
+
+    @property
+    def records(self) -> int:
+        return sum(entry["records"] for entry in self.parts.values())
+
+    @property
+    def bad(self) -> int:
+        return sum(entry["bad"] for entry in self.parts.values())
+
+    def percent(self) -> float:
+        """
+        Percentage of source bytes that have been converted
+        """
+
+        total = sum(self.sources.values())
+        if total < 1:
+            return 100.0 if self.complete else 0.0
+        done = sum(
+            entry["end"] - entry["start"] for entry in self.parts.values()
+        )
+        return 100.0 * done / total
+
+    def date_stats(self) -> Dict[str, Tuple[int, int]]:
+        """
+        :return: Date parsing statistics, summed over all parts, in
+            the format of `DateParser.stats()`
+        """
+
+        fallbacks = Counter()
+        failures = Counter()
+        for entry in self.parts.values():
+            for c, (f1, f2) in entry["dates"].items():
+                fallbacks[c] += f1
+                failures[c] += f2
+        return {
+            c: (fallbacks[c], failures[c])
+            for c in set(fallbacks) | set(failures)
+        }
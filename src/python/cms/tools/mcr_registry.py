@@ -22,7 +22,8 @@ Common content for the Medicare data model YAML file
 """
 
 import os
-import yaml
+
+from cms.tools.yaml_io import read_registry, write_registry
 
 
 class MedicareRegistry:
@@ -51,12 +52,10 @@ class MedicareRegistry:
         return
 
     def read_registry(self):
-        with open(self.registry_path) as f:
-            self.registry = yaml.safe_load(f)
+        self.registry = read_registry(self.registry_path)
         return
 
     def save(self):
-        with open(self.registry_path, "wt") as f:
-            yaml.dump(self.registry, f)
+        write_registry(self.registry_path, self.registry)
         return
 
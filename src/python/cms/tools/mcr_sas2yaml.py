@@ -28,10 +28,10 @@ import logging
 import re
 import sys
 from typing import List
-import yaml
 
 from cms.tools.mcr_registry import MedicareRegistry
 from cms.tools.mcr_sas import MedicareSAS
+from cms.tools.yaml_io import dump_yaml
 
 from nsaph.data_model.utils import split
 from nsaph.loader.introspector import Introspector
@@ -51,7 +51,7 @@ class SASIntrospector(MedicareSAS, MedicareRegistry):
         introspector = SASIntrospector(registry_path, root_dir)
         introspector.traverse(pattern)
         introspector.save()
-        yaml.dump(introspector.registry, sys.stdout)
+        dump_yaml(introspector.registry, sys.stdout)
         return
 
     def __init__(self, registry_path: str, root_dir: str = '.'):
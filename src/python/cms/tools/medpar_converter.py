@@ -39,14 +39,16 @@ import os
 import sys
 import traceback
 from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from typing import List, Optional
 
-from cms.tools.mcr_file import MedicareFile
+from cms.tools.compression import GZIP, CODECS, threads_per_worker
+from cms.tools.mcr_file import MedicareFile, DateParser
 
 
 class MedParFileSet:
-    def __init__(self, fts:str, dat: List[str], destination: str):
+    def __init__(self, fts:str, dat: List[str], destination: str,
+                 compression: str = GZIP):
         self.fts = fts
         self.dat = dat
         self.year = None
@@ -66,7 +68,8 @@ class MedParFileSet:
                     dir_path=self.dir,
                     name=self.name,
                     year=str(self.year),
-                    dest = os.path.join(destination, str(self.year))
+                    dest = os.path.join(destination, str(self.year)),
+                    compression=compression
                 )
         return
 
@@ -76,11 +79,15 @@ class MedParFileSet:
         )
 
 
+DEFAULT_SHARD_SIZE = 1000000
+
+
 class MedparConverter:
     @classmethod
-    def dataset(cls, fts, destination) -> Optional[MedParFileSet]:
+    def dataset(cls, fts, destination, compression: str = GZIP) \
+            -> Optional[MedParFileSet]:
         base, ext = os.path.splitext(fts)
-        csv_gz = sorted(glob.glob(base + "*.csv.gz"))
+        csv_gz = sorted(glob.glob(base + "*.csv." + compression))
         if csv_gz:
             print("Skipping " + fts)
             return None
@@ -90,74 +97,179 @@ class MedparConverter:
                 "Mismatch: {} does not have corresponding dat file(s)".
                     format(fts)
             )
-        return MedParFileSet(fts, dat, destination)
+        return MedParFileSet(fts, dat, destination, compression)
 
     @classmethod
-    def find(cls, basepath: str, destination: str) -> List[MedParFileSet]:
+    def find(cls, basepath: str, destination: str,
+             compression: str = GZIP) -> List[MedParFileSet]:
         datasets: List[MedParFileSet] = []
         fts_files = sorted(glob.glob(
             os.path.join(basepath, "**", "*.fts"),
             recursive=True
         ))
         for fts in fts_files:
-            ds = cls.dataset(fts, destination)
+            ds = cls.dataset(fts, destination, compression)
             if ds is not None:
                 datasets.append(ds)
         return datasets
 
     def __init__(self, source_path: str,
                  destination: str = None,
-                 verbose: bool = True):
+                 verbose: bool = True,
+                 workers: int = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE,
+                 compression: str = GZIP,
+                 threads: int = None,
+                 indexed: bool = False):
+        """
+        :param source_path: Path to a source directory or an FTS file
+        :param destination: Destination for converted files
+        :param verbose: Display additional information
+        :param workers: If specified, DAT files are split into shards
+            converted in parallel by the given number of processes
+        :param shard_size: Number of records in a shard
+        :param compression: Compression format for CSV files:
+            gz, zst or lz4
+        :param threads: Number of compression threads
+        :param indexed: Scan DAT files to build record indices and
+            use them to split the files into shards
+        """
+
         self.datasets: List[MedParFileSet] = []
         self.verbose = verbose
+        self.workers = workers
+        self.shard_size = shard_size
+        self.threads = threads
+        self.indexed = indexed
         if os.path.isdir(source_path):
             if destination is None:
                 destination = source_path
-            self.datasets = self.find(source_path, destination)
+            self.datasets = self.find(source_path, destination, compression)
         elif os.path.isfile(source_path):
             if destination is None:
                 raise ValueError(
                     "When source path is a single file, "
                     "destination must be defined"
                 )
-            self.datasets = [self.dataset(source_path, destination)]
+            self.datasets = [
+                self.dataset(source_path, destination, compression)
+            ]
 
     def list(self):
         for dataset in self.datasets:
             print(dataset)
 
     @staticmethod
-    def convert_dataset(dataset: MedParFileSet, verbose):
+    def convert_dataset(dataset: MedParFileSet, verbose, threads=None,
+                        checkpoint: int = DEFAULT_SHARD_SIZE,
+                        indexed: bool = False):
         try:
             status = dataset.reader.status()
-            if status in ["READY", "ERROR"] or "MISMATCH" in status:
+            if status in ["READY", "ERROR", "UNVERIFIED"] \
+                    or "MISMATCH" in status:
                 return "{}: SKIPPED[{}]".format(dataset.fts, status)
             if verbose:
                 dataset.reader.info()
-            dataset.reader.export()
+            dataset.reader.export(threads=threads, checkpoint=checkpoint,
+                                  indexed=indexed)
             return "{}: SUCCESS".format(dataset.fts)
         except Exception as x:
             traceback.print_exc()
             return "{}: FAILED".format(dataset.fts)
 
     def convert(self):
+        if self.workers:
+            self.convert_shards()
+            return
+        threads = self.threads
+        if not threads:
+            # datasets are compressed at the same time
+            threads = threads_per_worker(len(self.datasets))
         with ThreadPoolExecutor() as executor:
             futures = []
             for dataset in self.datasets:
                 futures.append(
                     executor.submit(self.convert_dataset,
                                     dataset=dataset,
-                                    verbose=self.verbose)
+                                    verbose=self.verbose,
+                                    threads=threads,
+                                    checkpoint=self.shard_size,
+                                    indexed=self.indexed)
                 )
         for future in concurrent.futures.as_completed(futures):
             print(future.result())
 
-    def status(self):
+    def convert_shards(self):
+        """
+        Converts shards of all datasets in a pool of processes, then
+        concatenates part files of every dataset into a single
+        compressed CSV file.
+
+        Every converted shard is recorded in the manifest of its
+        dataset, shards recorded by a previous interrupted
+        conversion are not converted again.
+        """
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            jobs = []
+            for dataset in self.datasets:
+                reader = dataset.reader
+                status = reader.status()
+                if status in ["READY", "ERROR", "UNVERIFIED"] \
+                    or "MISMATCH" in status:
+                    print("{}: SKIPPED[{}]".format(dataset.fts, status))
+                    continue
+                if self.verbose:
+                    reader.info()
+                reader.copy_fts()
+                manifest = reader.open_manifest(self.shard_size)
+                shards = reader.shards(self.shard_size, self.indexed)
+                parts = [reader.part_path(i) for i in range(len(shards))]
+                futures = {
+                    # a single compression thread in every process
+                    executor.submit(
+                        reader.export_shard, dat, start, end, part,
+                        threads=1
+                    ): (dat, start, end, part)
+                    for (dat, start, end), part in zip(shards, parts)
+                    if not manifest.is_done(part, dat, start, end)
+                }
+                jobs.append((dataset, manifest, parts, futures))
+            for dataset, manifest, parts, futures in jobs:
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        dat, start, end, part = futures[future]
+                        good, bad, date_stats = future.result()
+                        manifest.add(part, dat, start, end, good, bad,
+                                     date_stats)
+                        manifest.save()
+                    dataset.reader.concatenate(parts)
+                    manifest.finish()
+                    manifest.save()
+                    print("{}: SUCCESS. Shards: {:d}, bad lines: {:,}".format(
+                        dataset.fts, len(parts), manifest.bad
+                    ))
+                    dates = DateParser()
+                    dates.merge(manifest.date_stats())
+                    for line in dates.report():
+                        print("{}: {}".format(dataset.fts, line))
+                except Exception as x:
+                    traceback.print_exc()
+                    print("{}: FAILED".format(dataset.fts))
+
+    def status(self, verify: bool = False):
+        """
+        Prints conversion status of all datasets
+
+        :param verify: Count lines in source and destination files
+            instead of relying on metadata and export manifests
+        """
+
         with ThreadPoolExecutor() as executor:
             futures = []
             for dataset in self.datasets:
                 futures.append(
-                    executor.submit(dataset.reader.status_message)
+                    executor.submit(dataset.reader.status_message, verify)
                 )
         for future in concurrent.futures.as_completed(futures):
             print(future.result())
@@ -169,12 +281,29 @@ def args():
                         dest="input")
     parser.add_argument("--status", "-s", action='store_true',
                         help="Display status and exit")
+    parser.add_argument("--verify", action='store_true',
+                        help="With --status, count lines in source and "
+                             "converted files")
     parser.add_argument("--convert", "-c", action='store_true',
                         help="Do conversion")
     parser.add_argument("--verbose", "-v", action='store_true',
                         help="Display additional information")
     parser.add_argument("--destination", "-d",
                         help="Destination for converted files")
+    parser.add_argument("--workers", "-w", type=int,
+                        help="Number of processes converting shards of "
+                             "DAT files in parallel")
+    parser.add_argument("--shard-size", type=int, dest="shard_size",
+                        default=DEFAULT_SHARD_SIZE,
+                        help="Number of records in a shard, that is also "
+                             "the number of records between checkpoints")
+    parser.add_argument("--compression", choices=CODECS, default=GZIP,
+                        help="Compression format for CSV files")
+    parser.add_argument("--threads", "-t", type=int,
+                        help="Number of compression threads")
+    parser.add_argument("--index", action='store_true', dest="indexed",
+                        help="Scan DAT files for record boundaries before "
+                             "splitting them into shards")
     arguments = parser.parse_args()
     return arguments
 
@@ -184,11 +313,16 @@ if __name__ == '__main__':
     status = False
     converter = MedparConverter(source_path=my_args.input,
                                 destination=my_args.destination,
-                                verbose=my_args.verbose)
+                                verbose=my_args.verbose,
+                                workers=my_args.workers,
+                                shard_size=my_args.shard_size,
+                                compression=my_args.compression,
+                                threads=my_args.threads,
+                                indexed=my_args.indexed)
     if my_args.verbose:
         converter.list()
     if my_args.status:
-        converter.status()
+        converter.status(my_args.verify)
     if my_args.convert:
         converter.convert()
 
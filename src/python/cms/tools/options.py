@@ -0,0 +1,66 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Options of CMS tools, that are not part of nsaph configuration.
+
+Tools based on nsaph data loader read their configuration from
+the command line. The options specific to a tool are parsed first
+and removed from the command line, so that the configuration
+does not reject them as unknown.
+"""
+
+import sys
+from argparse import ArgumentParser, Namespace
+from typing import List
+
+
+def loader_parser() -> ArgumentParser:
+    """
+    Options controlling how Medicare DAT files are read and loaded
+    """
+
+    parser = ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--memory-map", action='store_true',
+                        dest="memory_map",
+                        help="Read DAT files through memory mapping")
+    parser.add_argument("--copy-format", choices=["text", "binary"],
+                        dest="copy_format",
+                        help="Stream DAT files into the database with "
+                             "parallel COPY commands in this format "
+                             "instead of inserting records")
+    return parser
+
+
+def split_arguments(parser: ArgumentParser,
+                    argv: List[str] = None) -> Namespace:
+    """
+    Parses the options known to a parser and removes them from
+    the command line
+
+    :param parser: Parser of tool specific options
+    :param argv: Command line arguments, by default `sys.argv`
+    :return: Parsed options
+    """
+
+    if argv is None:
+        argv = sys.argv
+    options, rest = parser.parse_known_args(argv[1:])
+    argv[1:] = rest
+    return options
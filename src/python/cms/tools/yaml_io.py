@@ -0,0 +1,159 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Reading and writing of the YAML data model (registry).
+
+LibYAML based loader and dumper are used when PyYAML has been built
+with LibYAML, they are an order of magnitude faster than the pure
+Python implementation.
+
+Optionally, a compiled JSON copy of the registry (sidecar) is written
+next to the YAML file, with `.json` suffix. The sidecar records
+the size and modification time of the YAML file and is ignored
+as soon as the YAML file is changed. Sidecars are written when
+`CMS_REGISTRY_SIDECAR` environment variable is set to a non-empty value
+other than "0", "no" or "off" and are kept up to date once they exist.
+"""
+
+import json
+import logging
+import os
+from typing import Optional
+
+import yaml
+
+
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+SIDECAR_ENV = "CMS_REGISTRY_SIDECAR"
+SIDECAR_SUFFIX = ".json"
+
+
+def load_yaml(stream):
+    """
+    Parses YAML document from a string or a file
+    """
+
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def dump_yaml(data, stream=None):
+    """
+    Serializes data as YAML. Returns a string if stream is not given
+    """
+
+    return yaml.dump(data, stream, Dumper=Dumper)
+
+
+def sidecar_path(path: str) -> str:
+    return path + SIDECAR_SUFFIX
+
+
+def sidecar_enabled() -> bool:
+    value = os.environ.get(SIDECAR_ENV, "").strip().lower()
+    return value not in ["", "0", "no", "off", "false"]
+
+
+def stamp(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_sidecar(path: str) -> Optional[dict]:
+    """
+    Reads compiled copy of a YAML file
+
+    :param path: Path to the YAML file
+    :return: Content of the YAML file or None if the sidecar does not
+        exist or is stale
+    """
+
+    sidecar = sidecar_path(path)
+    if not os.path.isfile(sidecar):
+        return None
+    try:
+        with open(sidecar) as f:
+            content = json.load(f)
+        if content.get("source") != stamp(path):
+            return None
+        return content["registry"]
+    except (OSError, ValueError, KeyError) as x:
+        logging.warning("Ignoring sidecar {}: {}".format(sidecar, str(x)))
+        return None
+
+
+def write_sidecar(path: str, registry: dict) -> bool:
+    """
+    Writes compiled copy of a YAML file, that has been just written
+
+    :param path: Path to the YAML file
+    :param registry: Content of the YAML file
+    :return: True if the sidecar has been written
+    """
+
+    sidecar = sidecar_path(path)
+    tmp = "{}.{:d}.tmp".format(sidecar, os.getpid())
+    try:
+        with open(tmp, "wt") as f:
+            json.dump({"source": stamp(path), "registry": registry}, f)
+        os.replace(tmp, sidecar)
+        return True
+    except (OSError, TypeError, ValueError) as x:
+        logging.warning("Sidecar is not written: {}: {}"
+                        .format(sidecar, str(x)))
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return False
+
+
+def read_registry(path: str) -> dict:
+    """
+    Reads the registry from its compiled sidecar if it is up to date,
+    otherwise parses YAML file
+    """
+
+    registry = read_sidecar(path)
+    if registry is not None:
+        return registry
+    with open(path) as f:
+        return load_yaml(f)
+
+
+def write_registry(path: str, registry: dict, sidecar: bool = None):
+    """
+    Writes the registry atomically: to a temporary file, that
+    then replaces the registry
+
+    :param path: Path to the registry
+    :param registry: Content of the registry
+    :param sidecar: Whether to write a compiled sidecar, by default
+        it is written if enabled by the environment or if the registry
+        already has one
+    """
+
+    tmp = "{}.{:d}.tmp".format(path, os.getpid())
+    with open(tmp, "wt") as f:
+        dump_yaml(registry, f)
+    os.replace(tmp, path)
+    if sidecar is None:
+        sidecar = sidecar_enabled() or os.path.isfile(sidecar_path(path))
+    if sidecar:
+        write_sidecar(path, registry)
@@ -0,0 +1,381 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Verification of loaded data against a stored baseline.
+
+Every table is profiled by a single query, grouped by partition
+columns (state and year). For each partition the profile contains:
+
+* number of rows
+* number of nulls in selected columns (null ratios are reported)
+* checksum of key columns: sum of 64-bit hashes of the keys of all
+  rows modulo 2^64, that does not depend on the order of rows
+
+Tables are profiled in parallel, each on its own connection.
+The profile can be saved as a baseline (JSON) and later compared with
+the database, reporting only the partitions that diverge. Profiling
+can be restricted to some states or years, e.g. the ones that have
+just been reloaded.
+"""
+
+import json
+import logging
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional
+
+from nsaph.db import Connection
+
+
+CHECKSUM_MODULO = 2 ** 64
+KEY_SEPARATOR = '|'
+NULL_VALUE = '\\N'
+
+
+class TableProfile:
+    """
+    Describes what is profiled in a table
+    """
+
+    def __init__(self, table: str, partition: List[Tuple[str, str]],
+                 keys: List[str], nullable: List[str]):
+        """
+        :param table: Qualified table name
+        :param partition: List of tuples (logical name, column) of the
+            partition columns, the logical names ("state", "year") are
+            used to restrict verification to some partitions
+        :param keys: Key columns, included into the checksum
+        :param nullable: Columns, for which null ratios are computed
+        """
+
+        self.table = table
+        self.partition = partition
+        self.keys = keys
+        self.nullable = nullable
+
+    @staticmethod
+    def quote(name: str) -> str:
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def qualified_name(self) -> str:
+        return '.'.join(self.quote(p) for p in self.table.split('.', 1))
+
+    def sql(self, restrict: Dict[str, List] = None) -> Tuple[str, list]:
+        """
+        Generates the profiling query
+
+        :param restrict: Dictionary mapping logical names of partition
+            columns to lists of values to verify
+        :return: Query and its parameters
+        """
+
+        partition = [self.quote(c) for _, c in self.partition]
+        hashed = ", ".join(
+            "COALESCE({}::text, '{}')".format(self.quote(k), NULL_VALUE)
+            for k in self.keys
+        )
+        select = ["{}::text".format(c) for c in partition]
+        select.append("COUNT(*)")
+        select.extend(
+            "COUNT(*) - COUNT({})".format(self.quote(c))
+            for c in self.nullable
+        )
+        select.append(
+            "SUM(('x' || substr(md5(concat_ws('{}', {})), 1, 16))"
+            "::bit(64)::bigint::numeric)".format(KEY_SEPARATOR, hashed)
+        )
+        sql = "SELECT\n    {}\nFROM {}".format(
+            ",\n    ".join(select), self.qualified_name()
+        )
+        conditions = []
+        params = []
+        for name, column in self.partition:
+            if restrict and restrict.get(name):
+                conditions.append(
+                    "{}::text = ANY(%s)".format(self.quote(column))
+                )
+                params.append([str(v) for v in restrict[name]])
+        if conditions:
+            sql += "\nWHERE " + " AND ".join(conditions)
+        if partition:
+            sql += "\nGROUP BY " + ", ".join(partition)
+        return sql, params
+
+    def partition_key(self, row) -> str:
+        n = len(self.partition)
+        return KEY_SEPARATOR.join(
+            str(v) if v is not None else NULL_VALUE for v in row[:n]
+        )
+
+    def parse(self, row) -> Tuple[str, dict]:
+        n = len(self.partition)
+        count = row[n]
+        nulls = {
+            c: row[n + 1 + i] for i, c in enumerate(self.nullable)
+        }
+        checksum = int(row[-1] or 0) % CHECKSUM_MODULO
+        return self.partition_key(row), {
+            "count": count,
+            "nulls": nulls,
+            "checksum": "{:016x}".format(checksum)
+        }
+
+    def matches(self, key: str, restrict: Dict[str, List] = None) -> bool:
+        """
+        Checks if a partition is within the restriction
+        """
+
+        if not restrict:
+            return True
+        values = key.split(KEY_SEPARATOR) if self.partition else []
+        for (name, _), value in zip(self.partition, values):
+            if restrict.get(name) and \
+                    value not in {str(v) for v in restrict[name]}:
+                return False
+        return True
+
+
+DEFAULT_PROFILES = [
+    TableProfile(
+        "cms.ps",
+        partition=[("state", "state_cd"), ("year", "max_yr_dt")],
+        keys=["bene_id", "msis_id"],
+        nullable=["bene_id", "el_dob", "el_dod"]
+    ),
+    TableProfile(
+        "medicaid.beneficiaries",
+        partition=[],
+        keys=["bene_id"],
+        nullable=["dob", "dod", "race_ethnicity_code", "sex"]
+    ),
+    TableProfile(
+        "medicaid.enrollments",
+        partition=[("state", "state"), ("year", "year")],
+        keys=["bene_id"],
+        nullable=["zip", "fips5", "residence_county"]
+    ),
+    TableProfile(
+        "medicaid.eligibility",
+        partition=[("state", "state"), ("year", "year")],
+        keys=["bene_id", "month"],
+        nullable=["eligibility_code", "managed_care_code"]
+    ),
+]
+
+
+class Verifier:
+    """
+    Profiles tables and compares the profiles with a baseline
+    """
+
+    def __init__(self, db: str, connection: str,
+                 profiles: List[TableProfile] = None):
+        """
+        :param db: Path to a database connection parameters file
+        :param connection: Section in the database connection
+            parameters file
+        :param profiles: Tables to profile, by default cms.ps and
+            medicaid tables
+        """
+
+        self.db = db
+        self.connection = connection
+        self.profiles = profiles if profiles else DEFAULT_PROFILES
+
+    def profile_table(self, profile: TableProfile,
+                      restrict: Dict[str, List] = None) -> Dict[str, dict]:
+        sql, params = profile.sql(restrict)
+        logging.debug(sql)
+        result = dict()
+        with Connection(self.db, self.connection,
+                        silent=True).connect() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                for row in cursor:
+                    key, stats = profile.parse(row)
+                    result[key] = stats
+        logging.info("{}: {:,d} partitions".format(profile.table, len(result)))
+        return result
+
+    def profile(self, restrict: Dict[str, List] = None) \
+            -> Dict[str, Dict[str, dict]]:
+        """
+        Profiles all tables in parallel
+
+        :param restrict: Dictionary mapping logical names of partition
+            columns ("state", "year") to lists of values to profile
+        :return: Dictionary: table -> partition -> statistics
+        """
+
+        with ThreadPoolExecutor(max_workers=len(self.profiles)) as executor:
+            results = executor.map(
+                lambda p: self.profile_table(p, restrict), self.profiles
+            )
+            return {
+                p.table: r for p, r in zip(self.profiles, results)
+            }
+
+    @staticmethod
+    def load_baseline(path: str) -> Dict[str, Dict[str, dict]]:
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def save_baseline(path: str, baseline: Dict[str, Dict[str, dict]],
+                      merge: bool = True):
+        """
+        Saves profiles as a baseline. If merge is True, partitions
+        that have not been profiled are kept from the existing baseline
+        """
+
+        if merge and os.path.isfile(path):
+            content = Verifier.load_baseline(path)
+            for table in baseline:
+                content.setdefault(table, dict()).update(baseline[table])
+        else:
+            content = baseline
+        tmp = path + ".tmp"
+        with open(tmp, "wt") as f:
+            json.dump(content, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def null_ratio(stats: dict, column: str) -> Optional[float]:
+        if not stats["count"]:
+            return None
+        return stats["nulls"].get(column, 0) / stats["count"]
+
+    def compare(self, actual: Dict[str, Dict[str, dict]],
+                baseline: Dict[str, Dict[str, dict]],
+                restrict: Dict[str, List] = None,
+                tolerance: float = 0.0) -> List[str]:
+        """
+        Compares profiles with a baseline
+
+        :param actual: Profiles, returned by `profile()`
+        :param baseline: Stored profiles
+        :param restrict: Only the partitions within the restriction
+            are compared
+        :param tolerance: Allowed difference in null ratios
+        :return: Descriptions of divergent partitions
+        """
+
+        problems = []
+        for profile in self.profiles:
+            table = profile.table
+            current = actual.get(table, dict())
+            expected = {
+                key: stats
+                for key, stats in baseline.get(table, dict()).items()
+                if profile.matches(key, restrict)
+            }
+            for key in sorted(set(current) | set(expected)):
+                name = "{} [{}]".format(table, key) if key else table
+                if key not in expected:
+                    problems.append("{}: not in the baseline".format(name))
+                    continue
+                if key not in current:
+                    problems.append("{}: missing".format(name))
+                    continue
+                a, e = current[key], expected[key]
+                if a["count"] != e["count"]:
+                    problems.append(
+                        "{}: count {:,d}, expected {:,d}".format(
+                            name, a["count"], e["count"]
+                        )
+                    )
+                elif a["checksum"] != e["checksum"]:
+                    problems.append("{}: checksum mismatch".format(name))
+                for column in profile.nullable:
+                    if column not in e["nulls"]:
+                        continue
+                    ra = self.null_ratio(a, column)
+                    re = self.null_ratio(e, column)
+                    if ra is None or re is None:
+                        continue
+                    if abs(ra - re) > tolerance:
+                        problems.append(
+                            "{}: null ratio of {} is {:.4f}, expected {:.4f}"
+                            .format(name, column, ra, re)
+                        )
+        return problems
+
+    def verify(self, baseline_path: str, restrict: Dict[str, List] = None,
+               tolerance: float = 0.0):
+        """
+        Profiles the database and compares it with the baseline
+
+        :raises ValueError: if any partition diverges
+        """
+
+        actual = self.profile(restrict)
+        problems = self.compare(
+            actual, self.load_baseline(baseline_path), restrict, tolerance
+        )
+        for problem in problems:
+            logging.error(problem)
+        if problems:
+            raise ValueError("Verification failed for {:d} partitions"
+                             .format(len(problems)))
+        logging.info("All partitions OK.")
+
+
+def args():
+    parser = ArgumentParser ("Verifies loaded data against a baseline")
+    parser.add_argument("--db",
+                        help="Path to a database connection parameters file",
+                        default="database.ini",
+                        required=False)
+    parser.add_argument("--connection",
+                        help="Section in the database connection parameters file",
+                        default="nsaph2",
+                        required=False)
+    parser.add_argument("--baseline",
+                        help="Path to the baseline file",
+                        required=True)
+    parser.add_argument("--save", action='store_true',
+                        help="Profile the database and save (merge) "
+                             "the result as the baseline")
+    parser.add_argument("--state", nargs='*', default=[],
+                        help="Verify only these states")
+    parser.add_argument("--year", nargs='*', default=[],
+                        help="Verify only these years")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="Allowed difference in null ratios")
+    arguments = parser.parse_args()
+    return arguments
+
+
+def main():
+    from nsaph import init_logging
+
+    init_logging()
+    arguments = args()
+    restrict = {"state": arguments.state, "year": arguments.year}
+    verifier = Verifier(arguments.db, arguments.connection)
+    if arguments.save:
+        verifier.save_baseline(arguments.baseline, verifier.profile(restrict))
+    else:
+        verifier.verify(arguments.baseline, restrict, arguments.tolerance)
+
+
+if __name__ == '__main__':
+    main()
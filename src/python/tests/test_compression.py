@@ -0,0 +1,54 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import gzip
+import os
+
+import pytest
+
+from cms.tools.compression import open_output, threads_per_worker
+
+
+DATA = "".join("{:d}\tline\n".format(i) for i in range(200000))
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_gzip_output(tmp_path, threads):
+    path = str(tmp_path / "out.csv.gz")
+    with open_output(path, "wt", threads=threads) as out:
+        out.write(DATA)
+    with gzip.open(path, "rt") as f:
+        assert f.read() == DATA
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_incomplete_output_is_removed(tmp_path, threads):
+    path = str(tmp_path / "out.csv.gz")
+    with pytest.raises(RuntimeError):
+        with open_output(path, "wt", threads=threads) as out:
+            out.write(DATA)
+            raise RuntimeError("interrupted")
+    assert not os.path.exists(path)
+
+
+def test_threads_per_worker():
+    cpus = os.cpu_count() or 1
+    assert threads_per_worker() == cpus
+    assert threads_per_worker(1) == cpus
+    assert threads_per_worker(cpus * 2) == 1
@@ -0,0 +1,75 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import numpy
+
+from cms.tools.mcr_index import RecordIndex
+
+
+RECORD_LEN = 61
+N = 2000
+
+
+def records():
+    return [
+        "B{:d}".format(i).ljust(15).encode("utf-8") + b"x" * (RECORD_LEN - 15)
+        for i in range(N)
+    ]
+
+
+def write(path, terminator: bytes) -> str:
+    with open(str(path), "wb") as f:
+        for r in records():
+            f.write(r + terminator)
+    return str(path)
+
+
+def test_terminated_file(tmp_path):
+    dat = write(tmp_path / "a.dat", b"\r\n")
+    index = RecordIndex.build(dat, RECORD_LEN)
+    assert len(index) == N
+    assert index.offset(5) == 5 * (RECORD_LEN + 2)
+    assert RecordIndex.count_records(dat, RECORD_LEN) == N
+
+
+def test_file_without_terminators(tmp_path):
+    dat = write(tmp_path / "b.dat", b"")
+    index = RecordIndex.build(dat, RECORD_LEN)
+    assert len(index) == N
+    assert index.offset(5) == 5 * RECORD_LEN
+    assert index.count(RECORD_LEN) == N
+    assert RecordIndex.count_records(dat, RECORD_LEN) == N
+    assert len(index.shards(500)) == 4
+
+
+def test_incomplete_sidecar_is_rebuilt(tmp_path):
+    dat = write(tmp_path / "c.dat", b"")
+    # an index built without the record length has a single record
+    RecordIndex.build(dat).save()
+    assert RecordIndex.load(dat, RECORD_LEN) is None
+    index = RecordIndex.open(dat, RECORD_LEN)
+    assert len(index) == N
+    assert len(RecordIndex.load(dat, RECORD_LEN)) == N
+
+
+def test_keys_without_terminators(tmp_path):
+    dat = write(tmp_path / "d.dat", b"")
+    index = RecordIndex.build(dat, RECORD_LEN)
+    index.build_keys("BENE_ID", 0, 15, RECORD_LEN)
+    assert numpy.array_equal(index.find("B1234"), [1234])
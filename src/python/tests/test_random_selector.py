@@ -0,0 +1,51 @@
+#  Copyright (c) 2022. Harvard University
+#
+#  Developed by Research Software Engineering,
+#  Faculty of Arts and Sciences, Research Computing (FAS RC)
+#  Author: Michael A Bouzinier
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import gzip
+import io
+
+from cms.random_selector import Sampler
+
+
+def test_empty_file_with_header_key(tmp_path):
+    src = tmp_path / "empty.csv"
+    src.write_bytes(b"")
+    dest = tmp_path / "empty.csv.gz"
+    sampler = Sampler(0.5, key="BENE_ID")
+    msg = sampler.sample_file(str(src), str(dest))
+    assert msg.endswith(": 0/0")
+    with gzip.open(str(dest), "rb") as f:
+        assert f.read() == b""
+
+
+def test_lines_without_key_are_skipped():
+    data = b"ID,BENE_ID\n1,B1\n\n2\n3,\n4,B4\n"
+    output = io.BytesIO()
+    n1, n2, skipped = Sampler(1.0, key="BENE_ID").sample(
+        io.BytesIO(data), output, "f"
+    )
+    assert (n1, n2, skipped) == (5, 2, 3)
+    assert output.getvalue() == b"ID,BENE_ID\n1,B1\n4,B4\n"
+
+
+def test_key_hash_ignores_padding_and_quotes():
+    sampler = Sampler(0.5, key="0")
+    expected = sampler.key_hash(b"B1\n", 0)
+    for line in [b"B1             \n", b" B1,x\n", b'"B1   ",x\n']:
+        assert sampler.key_hash(line, 0) == expected